@@ -0,0 +1,567 @@
+### Blackjack HiLo strategy assistant ###
+#
+# Watches the table through a camera, reads the player's and the dealer's
+# cards when asked to, keeps the HiLo running count and suggests a bet and
+# an action, optionally signalling them to an Arduino. main.py,
+# CardAssistant.py and WithArduino.py are shortcuts for this command line
+# with the settings they always had.
+#
+# Importing this module touches no device and doesn't even import OpenCV,
+# so tests and tools can use the strategy functions for free. Assistant.start()
+# opens the camera and the serial port and loads the templates concurrently
+# in background threads, and each of them is only waited for when it is
+# first needed. With --workers, scans are detected in a pool of worker
+# processes instead of on the main thread. With --tracker, cards are kept
+# between frames and only re-detected where the table changed.
+#
+# Usage: python Assistant.py [--camera 1] [--port COM12 --protocol binary] [--workers 2] [options]
+
+import os
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import ConfidenceAggregator
+import Metrics
+import Profiler
+
+# Camera settings. The camera can also be a video file, for testing.
+IM_WIDTH = 1280
+IM_HEIGHT = 720
+FRAME_RATE = 10
+CAMERA_INDEX = 1
+
+# Seconds a scan lasts at most, if the cards don't settle before
+SCAN_SECONDS = 10
+
+# Decks left in the shoe, for the true count
+DECKS_REMAINING = 2
+
+# Serial settings. The Arduino resets when its port is opened and ignores
+# commands until it has booted, ARDUINO_SETTLE seconds later.
+ARDUINO_BAUDRATE = 9600
+ARDUINO_SETTLE = 2.0
+
+# How advice is sent to the Arduino. 'binary' sends the bet as three binary
+# digits and then the action as H, S or D. 'signal' sends the action as
+# A_H, A_S or A_D and then the bet as B<units>.
+ARDUINO_PROTOCOLS = ['binary', 'signal']
+
+RANK_SYMBOLS = {'Ace': 'A', 'Two': '2', 'Three': '3', 'Four': '4', 'Five': '5', 'Six': '6', 'Seven': '7',
+                'Eight': '8', 'Nine': '9', 'Ten': '10', 'Jack': 'J', 'Queen': 'Q', 'King': 'K'}
+ACTION_CODES = {'Hit': 'H', 'Stand': 'S', 'Double Down': 'D'}
+
+
+def calculate_card_value(card):
+    """Calculate HiLo value for a card."""
+    if card in ['J', 'Q', 'K', 'A']:
+        return -1
+    card = int(card)
+    if 2 <= card <= 6:
+        return 1
+    elif 7 <= card <= 9:
+        return 0
+    else:
+        return -1
+
+
+def card_points(card):
+    """Blackjack points of a card, counting an ace as 11."""
+    if card in ['J', 'Q', 'K']:
+        return 10
+    elif card == 'A':
+        return 11
+    return int(card)
+
+
+def hand_total(cards):
+    """Best blackjack total of a hand, counting aces as 1 where 11 would bust."""
+    total = sum(card_points(card) for card in cards)
+    ace_count = cards.count('A')
+    while total > 21 and ace_count > 0:
+        total -= 10
+        ace_count -= 1
+    return total
+
+
+def get_action(player_total, dealer_card, true_count):
+    """Return the action based on HiLo strategy."""
+    if isinstance(dealer_card, str):
+        dealer_card = card_points(dealer_card)
+
+    if player_total >= 17:
+        return "Stand"
+    elif player_total >= 13 and dealer_card <= 6:
+        return "Stand"
+    elif player_total == 12 and 4 <= dealer_card <= 6:
+        return "Stand"
+    elif player_total == 11:
+        return "Double Down" if true_count >= 2 else "Hit"
+    elif player_total == 10:
+        return "Double Down" if dealer_card <= 9 and true_count >= 2 else "Hit"
+    elif player_total == 9 and 3 <= dealer_card <= 6:
+        return "Double Down" if true_count >= 2 else "Hit"
+    else:
+        return "Hit"
+
+
+def get_bet_amount(true_count):
+    """Suggest the bet amount in units based on the true count."""
+    if true_count <= 1:
+        return 1  # Minimum bet
+    elif 1 < true_count <= 3:
+        return 2  # Moderate bet
+    elif 3 < true_count <= 5:
+        return 3  # Higher bet
+    else:
+        return 5  # Maximum bet
+
+
+def get_best_cards(cards_confidence):
+    """Get the ranks seen in a zone, as card symbols, from its Rank_stats."""
+    return [RANK_SYMBOLS.get(rank, rank) for rank, stats in cards_confidence.items()
+            if stats.count and rank != "Unknown"]
+
+
+class Arduino:
+    """Serial link to the Arduino. open() returns as soon as the port is
+    open; the first command waits until the Arduino has had ARDUINO_SETTLE
+    seconds to boot, so the wait overlaps with the rest of the startup."""
+
+    def __init__(self, port, protocol='binary', baudrate=ARDUINO_BAUDRATE):
+        if protocol not in ARDUINO_PROTOCOLS:
+            raise ValueError("Unknown Arduino protocol '%s'" % protocol)
+        self.port = port
+        self.protocol = protocol
+        self.baudrate = baudrate
+        self.serial = None
+        self.ready_time = 0.0
+
+    def open(self):
+        """Opens the serial port."""
+
+        import serial
+        print(f"Connecting to Arduino on port {self.port}...")
+        self.serial = serial.Serial(port=self.port, baudrate=self.baudrate, timeout=1)
+        self.ready_time = time.monotonic() + ARDUINO_SETTLE
+        return self
+
+    def write(self, command):
+        """Sends one newline terminated command."""
+
+        delay = self.ready_time - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        with Metrics.timer('serial_send_seconds'):
+            self.serial.write((command + '\n').encode())
+
+    def send_advice(self, bet_units, action):
+        """Sends the suggested bet and action in the link's protocol."""
+
+        try:
+            if self.protocol == 'binary':
+                self.write(format(bet_units, '03b'))
+                time.sleep(0.1)  # Short delay to ensure Arduino processes the command
+                self.write(ACTION_CODES[action])
+                time.sleep(0.1)
+            else:
+                self.write('A_' + ACTION_CODES[action])
+                self.write('B%d' % bet_units)
+        except Exception as e:
+            print(f"Error communicating with Arduino: {e}")
+
+    def close(self):
+        if self.serial is not None:
+            self.serial.close()
+
+
+class Assistant:
+    """HiLo assistant for one camera, configured by the parsed command line
+    options. start() begins opening the devices and loading the templates;
+    the videostream, banks and arduino properties wait for them."""
+
+    def __init__(self, options):
+        self.options = options
+        self.running_count = 0
+        self.last_frame_time = 0.0  # Capture time of the last frame a scan used
+        self.loading = {}  # Name -> future of a device or the templates
+        self.loader = None
+        self.preview = None
+        self.card_cache = None
+        self.card_executor = None
+        self.tracker = None
+        self.profiler = None
+        self.metrics_exporter = None
+
+    def start(self):
+        """Opens the camera and the Arduino and loads the templates, all at
+        once in background threads. Must be called from the main thread."""
+
+        import Preview
+        import CardCache
+
+        options = self.options
+        self.loader = ThreadPoolExecutor(4)
+        self.loading['videostream'] = self.loader.submit(self.open_camera)
+        self.loading['banks'] = self.loader.submit(self.load_banks)
+        if options.port:
+            self.loading['arduino'] = self.loader.submit(Arduino(options.port, options.protocol).open)
+        if options.workers > 0:
+            self.loading['pool'] = self.loader.submit(self.start_pool)
+
+        # Optionally preprocess the cards of a frame in parallel threads
+        if options.card_threads > 0:
+            self.card_executor = ThreadPoolExecutor(options.card_threads)
+
+        # Preview window, or stdin and signal input when running headless
+        self.preview = Preview.Preview("Card Detector", options.headless, options.preview_every,
+                                       options.preview_scale)
+
+        # Reuse the match of cards that haven't moved or changed since they were last matched
+        self.card_cache = CardCache.Identity_cache()
+
+        # Optionally time the pipeline, and export the metrics
+        if options.metrics:
+            Metrics.instrument_cards()
+            self.metrics_exporter = Metrics.Exporter(options.metrics).start()
+
+        # Profile the next scan frames on 'p', SIGUSR2 or when the control file appears
+        self.profiler = Profiler.Frame_profiler(options.profile_dir, fmt=options.profile_format,
+                                                control_file=options.profile_control).listen()
+        return self
+
+    def open_camera(self):
+        """Opens the camera. VideoStream reads the first frame before it
+        returns, so the stream is ready to use."""
+
+        import VideoStream
+        camera = str(self.options.camera)
+        print(f"Initializing video stream with camera {camera}...")
+        src = int(camera) if camera.isdigit() else camera
+        videostream = VideoStream.VideoStream((IM_WIDTH, IM_HEIGHT), FRAME_RATE, 2, src, low_latency=True).start()
+        if self.options.metrics:
+            Metrics.instrument_stream(videostream)
+        return videostream
+
+    def load_banks(self):
+        """Maps the rank and suit templates from the template bank."""
+
+        import TemplateBank
+        return TemplateBank.load_banks()
+
+    def start_pool(self):
+        """Starts the detection worker processes and a paused feeder that
+        publishes the camera frames to them during scans."""
+
+        import FrameBus
+        import MultiTable
+        videostream = self.videostream
+        print(f"Starting {self.options.workers} detection workers...")
+        pool = FrameBus.Detection_pool(videostream.read(copy=False).shape, self.options.workers, suits=False,
+                                       context=MultiTable.WORKER_CONTEXT)
+        pool.pause()
+        return pool.feed(videostream)
+
+    @property
+    def videostream(self):
+        return self.loading['videostream'].result()
+
+    @property
+    def banks(self):
+        return self.loading['banks'].result()
+
+    @property
+    def pool(self):
+        """The detection pool, or None if scans run on the main thread."""
+        if 'pool' not in self.loading:
+            return None
+        return self.loading['pool'].result()
+
+    @property
+    def arduino(self):
+        """The Arduino link, or None if there is no Arduino."""
+        if 'arduino' not in self.loading:
+            return None
+        return self.loading['arduino'].result()
+
+    def detect_cards(self, scan_duration, stable_frames=ConfidenceAggregator.STABLE_FRAMES):
+        """Detect cards for at most scan_duration seconds and return detected player and dealer cards.
+        The scan ends early once the ranks seen in both zones have been stable for stable_frames matched frames.
+        With a detection pool, every frame is detected by the workers and results are taken in frame
+        order; otherwise frames are detected here once the motion gate lets them through, and again on
+        the still frames that follow until the scan could have become stable. With the tracker, only
+        the regions that changed are detected again."""
+        import cv2
+        import Cards
+        import MotionGate
+        import CardTracker
+
+        videostream = self.videostream
+        pool = self.pool
+        # Still frames after a settled detection that are matched again. A
+        # rank needs a couple of frames to lead its zone and then has to hold
+        # the lead for stable_frames more, so twice that is enough for a scan
+        # of a still table to end early on real matches only.
+        confirm_frames = 2 * stable_frames
+        if pool is None:
+            rank_bank, suit_bank = self.banks
+            # The tracker lives across scans, so cards that stay put are never detected again
+            if self.options.tracker and self.tracker is None:
+                self.tracker = CardTracker.Card_tracker(rank_bank, suit_bank, executor=self.card_executor,
+                                                        suits=False)
+            if self.tracker is not None:
+                self.tracker.confirm_frames = confirm_frames
+                self.tracker.confirm(confirm_frames)
+        else:
+            pool.resume()
+        aggregator = ConfidenceAggregator.Confidence_aggregator(['dealer', 'player'], stable_frames)
+        scan_start_time = time.time()
+        scan_start_tick = time.monotonic()
+        last_seq = 0
+        motion_gate = MotionGate.Motion_gate()
+        confirm_left = 0
+        observations = None
+        if self.tracker is not None and pool is None and len(self.tracker.cards) != 0:
+            # Cards the tracker already holds count as seen, until they change
+            observations = self.observe(self.tracker.cards, videostream.read(copy=False).shape[0])
+
+        while time.time() - scan_start_time < scan_duration:
+            if pool is not None:
+                # Results come back in frame order. Frames published before
+                # the scan started are left over from the last one.
+                result = pool.get(timeout=0.1)
+                if result is None:
+                    continue
+                seq, timestamp, cards = result
+                # Frames the pool couldn't detect are no evidence either way
+                if timestamp < scan_start_tick or cards is None:
+                    continue
+                self.last_frame_time = timestamp
+                self.profiler.frame_start()
+                image = videostream.read(copy=False)
+                observations = self.observe(cards, image.shape[0])
+                fresh = True
+                Metrics.observe('cards_per_frame', len(observations), Metrics.COUNT_BOUNDS)
+            else:
+                # Only process frames that haven't been seen yet
+                new_frame = videostream.read_new(last_seq, timeout=0.1, copy=False)
+                if new_frame is None:
+                    continue
+                last_seq, self.last_frame_time, image = new_frame
+                self.profiler.frame_start()
+
+            if pool is None and self.tracker is not None:
+                # The tracker gates on motion itself and keeps the cards of
+                # the regions that didn't change
+                cards = self.tracker.update(image)
+                fresh = self.tracker.detected
+                if fresh:
+                    observations = self.observe(cards, image.shape[0])
+                    Metrics.observe('cards_per_frame', len(observations), Metrics.COUNT_BOUNDS)
+                elif self.tracker.gate.state == MotionGate.MOVING:
+                    observations = None
+            elif pool is None:
+                # Only detect when the table has changed and settled again. Frames
+                # identical to the last detected one add no new evidence, and frames
+                # with a hand moving over the cards are blurred. The still frames
+                # right after a change are matched too, as independent evidence.
+                fresh = motion_gate.update(image)
+                if fresh:
+                    confirm_left = confirm_frames
+                elif motion_gate.state == MotionGate.STILL and confirm_left > 0:
+                    confirm_left = confirm_left - 1
+                    fresh = True
+                if fresh:
+                    cards = []
+                    pre_proc = Cards.preprocess_image(image)
+                    cnts_sort, cnt_is_card, cnt_corners = Cards.find_cards(pre_proc)
+                    if len(cnts_sort) != 0:
+                        cards = Cards.preprocess_cards(cnts_sort, cnt_is_card, image, self.card_executor,
+                                                       cnt_corners, suits=False)
+                        matches = self.card_cache.match_cards(cards, rank_bank, suit_bank, suits=False)
+                        for card, (rank_name, _, rank_diff, _) in zip(cards, matches):
+                            card.best_rank_match, card.rank_diff = rank_name, rank_diff
+                    observations = self.observe(cards, image.shape[0])
+                    Metrics.observe('cards_per_frame', len(observations), Metrics.COUNT_BOUNDS)
+                elif motion_gate.state == MotionGate.MOVING:
+                    observations = None
+
+            # A still frame shows the same cards as the last detected one, so it
+            # counts as seeing them again, but only matched frames count towards
+            # stability. Moving frames add no evidence.
+            stable = False
+            if observations is not None:
+                for zone, rank, confidence in observations:
+                    aggregator.add(zone, rank, confidence)
+                stable = aggregator.end_frame(fresh)
+
+            # Draw the overlay on a copy, the frame itself belongs to the capture ring
+            if self.preview.due():
+                display = image.copy()
+                cv2.putText(display, "Detecting Cards...", (10, 26), cv2.FONT_HERSHEY_SIMPLEX, 0.7,
+                            (255, 0, 255), 2, cv2.LINE_AA)
+                self.preview.show(display)
+            key = self.preview.poll_key()
+            if key == 'p':
+                self.profiler.request()
+            self.profiler.frame_end(len(observations) if observations else 0)
+
+            if stable:
+                print(f"Cards stable after {time.time() - scan_start_time:.1f} s")
+                break
+            # A quit signal ends the scan too, and is left for run() to see
+            if key == 'q' or self.preview.quit:
+                break
+
+        if pool is not None:
+            pool.pause()
+        dealer_cards = get_best_cards(aggregator.stats['dealer'])
+        player_cards = get_best_cards(aggregator.stats['player'])
+        return player_cards, dealer_cards
+
+    def observe(self, cards, height):
+        """Returns a (zone, rank, confidence) observation for every matched
+        card of a frame height pixels high. Cards in the upper half of the
+        frame are the dealer's."""
+        import numpy as np
+
+        observations = []
+        for card in cards:
+            confidence = 1.0 / (card.rank_diff + 1)
+            centroid_y = np.mean(card.contour[:, :, 1])
+            zone = 'dealer' if centroid_y < height / 2 else 'player'
+            observations.append((zone, card.best_rank_match, confidence))
+        return observations
+
+    def advise(self, player_cards, dealer_card):
+        """Updates the running count with a dealt hand, prints the suggested
+        bet and action, and sends them to the Arduino if there is one."""
+
+        for card in player_cards:
+            self.running_count += calculate_card_value(card)
+        self.running_count += calculate_card_value(dealer_card)
+
+        true_count = self.running_count / self.options.decks
+        print(f"\nCurrent Running Count: {self.running_count}")
+        print(f"True Count: {true_count:.2f}")
+
+        bet_units = get_bet_amount(true_count)
+        print(f"Suggested Bet: {bet_units} unit(s)")
+
+        player_total = hand_total(player_cards)
+        action = get_action(player_total, dealer_card, true_count)
+        print(f"Player Total: {player_total}")
+        print(f"Recommended Action: {action}")
+
+        if self.arduino is not None:
+            self.arduino.send_advice(bet_units, action)
+        Metrics.observe('advice_seconds', time.monotonic() - self.last_frame_time)
+
+    def run(self):
+        """Shows the camera and scans the table on 's' until 'q'."""
+        import cv2
+
+        print("Blackjack HiLo Strategy Assistant")
+        if self.options.headless:
+            print("Running headless. Type 's' and Enter (or send SIGUSR1) to detect cards, 'q' to quit.")
+        else:
+            print("Press 's' to start detecting cards or 'q' to quit.")
+        print("Press 'p' (or send SIGUSR2) to profile the next scan frames.")
+
+        videostream = self.videostream
+        last_seq = 0
+        while True:
+            new_frame = videostream.read_new(last_seq, timeout=0.1, copy=False)
+            if new_frame is not None:
+                last_seq, _, image = new_frame
+                if self.preview.due():
+                    display = image.copy()
+                    cv2.putText(display, "Press 's' to scan cards or 'q' to quit.", (10, 26),
+                                cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 0, 255), 2, cv2.LINE_AA)
+                    self.preview.show(display)
+            key = self.preview.poll_key()
+            if self.preview.quit:
+                key = 'q'  # A quit signal
+
+            if key == 's':
+                print(f"\nStarting scan (up to {self.options.scan_seconds:g} seconds)...")
+                player_cards, dealer_cards = self.detect_cards(self.options.scan_seconds)
+                if self.preview.quit:
+                    continue
+
+                if not player_cards or not dealer_cards:
+                    print("No cards detected. Try again.")
+                    continue
+
+                dealer_card = dealer_cards[0]
+                print(f"Player Cards: {player_cards}")
+                print(f"Dealer Card: {dealer_card}")
+                self.advise(player_cards, dealer_card)
+                print("\nPress 's' to start a new round or 'q' to quit.")
+
+            elif key == 'p':
+                self.profiler.request()
+
+            elif key == 'q':
+                print("Exiting...")
+                break
+
+    def stop(self):
+        """Closes the preview and whatever devices were opened."""
+
+        if self.preview is not None:
+            self.preview.close()
+        # In reverse, so the pool's feeder stops before the camera does
+        for name, future in reversed(list(self.loading.items())):
+            if future.exception() is not None:
+                continue
+            if name == 'videostream':
+                future.result().stop()
+            elif name == 'arduino':
+                future.result().close()
+            elif name == 'pool':
+                future.result().close()
+        if self.loader is not None:
+            self.loader.shutdown()
+        if self.metrics_exporter is not None:
+            self.metrics_exporter.stop()
+
+
+def parse_args(argv=None, **defaults):
+    """Parses the command line. defaults override the built-in defaults, so
+    shortcut scripts can keep their own settings."""
+
+    parser = argparse.ArgumentParser(description="Blackjack HiLo strategy assistant.")
+    parser.add_argument('--camera', default=str(CAMERA_INDEX), help="camera index, or a video file to replay")
+    parser.add_argument('--port', default=None, help="serial port of the Arduino to send advice to")
+    parser.add_argument('--protocol', default='binary', choices=ARDUINO_PROTOCOLS, help="how advice is sent to the Arduino")
+    parser.add_argument('--scan-seconds', type=float, default=SCAN_SECONDS, help="maximum length of a scan")
+    parser.add_argument('--decks', type=float, default=DECKS_REMAINING, help="decks remaining in the shoe")
+    parser.add_argument('--workers', type=int, default=0, help="detect cards in this many worker processes")
+    parser.add_argument('--tracker', action='store_true', help="keep cards between frames and only re-detect where the table changed (without --workers)")
+    parser.add_argument('--card-threads', type=int, default=0, help="preprocess the cards of a frame in this many threads")
+    parser.add_argument('--headless', action='store_true', default=None, help="no window, keys come from stdin or signals (or set CARD_HEADLESS=1)")
+    parser.add_argument('--preview-every', type=int, default=1, help="only show every Nth frame in the preview")
+    parser.add_argument('--preview-scale', type=float, default=1.0, help="size of the preview relative to the camera frame")
+    parser.add_argument('--metrics', default=os.environ.get('CARD_METRICS_FILE'), help="rewrite pipeline metrics to this file (.prom for Prometheus)")
+    parser.add_argument('--profile-dir', default=os.environ.get('CARD_PROFILE_DIR', '.'), help="where on-demand profiles are written")
+    parser.add_argument('--profile-format', default=os.environ.get('CARD_PROFILE_FORMAT', Profiler.PROFILE_FORMAT), choices=Profiler.PROFILE_FORMATS, help="collapsed stacks with the Cards stage of each sample, or pstats")
+    parser.add_argument('--profile-control', default=os.environ.get('CARD_PROFILE_CONTROL'), help="creating this file starts a profile")
+    parser.set_defaults(**defaults)
+    options = parser.parse_args(argv)
+
+    if options.headless is None:
+        import Preview
+        options.headless = Preview.is_headless(False)
+    return options
+
+
+def main(argv=None, **defaults):
+    assistant = Assistant(parse_args(argv, **defaults)).start()
+    try:
+        assistant.run()
+    finally:
+        assistant.stop()
+
+
+if __name__ == "__main__":
+    main()
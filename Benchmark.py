@@ -0,0 +1,495 @@
+### Benchmark for the card detection pipeline ###
+#
+# Replays a video file or a directory of images through the Cards pipeline
+# and times each stage separately. Runs headless, no camera or display is
+# needed, so it can be used to catch performance regressions.
+#
+# With --synthetic, frames are generated by SyntheticTable instead, and the
+# benchmark sweeps card count and resolution, reporting detection accuracy
+# next to throughput. With --synthetic --parity, it instead compares the
+# corner-only warp with the full card flattening on the same cards.
+#
+# With --scan-check, it runs Assistant scans on a still table (a synthetic
+# one unless a source is given) with each detection mode, and fails unless
+# every scan ends early on stable cards.
+#
+# Usage: python Benchmark.py <video file or image directory> [options]
+#        python Benchmark.py --synthetic [--cards 1,4,8] [--resolutions 1280x720] [--parity]
+#        python Benchmark.py --scan-check [video file]
+
+import os
+import sys
+import argparse
+import json
+import time
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import Cards
+import VideoStream
+import SyntheticTable
+import FrameBus
+import CardTracker
+import CardCache
+import TemplateBank
+import Assistant
+
+# Pipeline stages, in the order they run on each frame
+STAGES = ['preprocess_image', 'find_cards', 'preprocess_card', 'match_card', 'draw_results']
+
+# Latency percentiles reported for each stage
+PERCENTILES = [50, 95, 99]
+
+# Assistant options of the detection modes --scan-check runs, and how long
+# each scan may take at most
+SCAN_MODES = {'gate': [], 'tracker': ['--tracker'], 'workers': ['--workers', '2']}
+SCAN_CHECK_SECONDS = 10
+
+
+def load_banks(path=None):
+    """Maps the rank and suit train images from their template bank as
+    Train_bank objects."""
+
+    return TemplateBank.load_banks(path)
+
+
+def run_frame(image, rank_bank, suit_bank, times, backend='absdiff', draw=True, executor=None, scale=1,
+              external=False, suits=True, cache=None, fast_warp=False):
+    """Runs one frame through the pipeline, appending the time in seconds
+    spent in each stage to the lists in times. draw_results is skipped if
+    draw is False, cards are preprocessed concurrently if an executor is
+    given, and contours are searched for on an image shrunk by scale, only
+    retrieving outermost contours if external is True. Only ranks are
+    matched if suits is False, and cards are looked up in cache, a
+    CardCache.Identity_cache, before they are matched. Only card corners are
+    warped if fast_warp is True. Returns the query cards."""
+
+    t0 = time.perf_counter()
+    pre_proc = Cards.preprocess_image(image, scale=scale)
+    t1 = time.perf_counter()
+    cnts_sort, cnt_is_card, cnt_corners = Cards.find_cards(pre_proc, scale, external)
+    t2 = time.perf_counter()
+    cards = Cards.preprocess_cards(cnts_sort, cnt_is_card, image, executor, cnt_corners, suits, fast_warp)
+    t3 = time.perf_counter()
+    if cache is None:
+        matches = Cards.match_cards(cards, rank_bank, suit_bank, backend, suits=suits)
+    else:
+        matches = cache.match_cards(cards, rank_bank, suit_bank, backend, suits=suits)
+    for card, (rank_name, suit_name, rank_diff, suit_diff) in zip(cards, matches):
+        card.best_rank_match, card.best_suit_match = rank_name, suit_name
+        card.rank_diff, card.suit_diff = rank_diff, suit_diff
+    t4 = time.perf_counter()
+    if draw:
+        for card in cards:
+            image = Cards.draw_results(image, card)
+    t5 = time.perf_counter()
+
+    for stage, start, end in zip(STAGES, [t0, t1, t2, t3, t4], [t1, t2, t3, t4, t5]):
+        if draw or stage != 'draw_results':
+            times[stage].append(end - start)
+    return cards
+
+
+def summarize(times, num_frames, num_cards, elapsed):
+    """Builds a report dictionary with throughput and per-stage latency
+    percentiles (in milliseconds) from the collected stage times."""
+
+    report = {
+        'frames': num_frames,
+        'cards': num_cards,
+        'seconds': elapsed,
+        'frames_per_sec': num_frames / elapsed if elapsed > 0 else 0.0,
+        'cards_per_sec': num_cards / elapsed if elapsed > 0 else 0.0,
+        'stages': {},
+    }
+    for stage in times:
+        samples = np.array(times[stage]) * 1000
+        if len(samples) == 0:
+            continue
+        stats = {'mean_ms': float(np.mean(samples))}
+        for p, value in zip(PERCENTILES, np.percentile(samples, PERCENTILES)):
+            stats['p%d_ms' % p] = float(value)
+        report['stages'][stage] = stats
+    return report
+
+
+def print_report(report):
+    """Prints a benchmark report as a table."""
+
+    print("Frames: %d  Cards: %d  Time: %.2f s" % (report['frames'], report['cards'], report['seconds']))
+    print("Frames/sec: %.1f  Cards/sec: %.1f" % (report['frames_per_sec'], report['cards_per_sec']))
+    print("%-18s %10s" % ('Stage (ms/frame)', 'mean') + ''.join(' %9s' % ('p%d' % p) for p in PERCENTILES))
+    for stage, stats in report['stages'].items():
+        print("%-18s %10.3f" % (stage, stats['mean_ms'])
+              + ''.join(' %9.3f' % stats['p%d_ms' % p] for p in PERCENTILES))
+    if 'cache_hits' in report:
+        print("Cache hits: %d  misses: %d  hit rate: %.1f%%"
+              % (report['cache_hits'], report['cache_misses'], 100 * report['cache_hit_rate']))
+
+
+def benchmark(frames, rank_bank, suit_bank, backend='absdiff', warmup=0, executor=None, scale=1,
+              external=False, suits=True, cache=None, fast_warp=False):
+    """Times the pipeline over an iterable of frames. The first warmup
+    frames are processed but not counted. Returns a report dictionary,
+    including the cache hits and misses if a cache is given."""
+
+    times = {stage: [] for stage in STAGES}
+    num_frames = 0
+    num_cards = 0
+    elapsed = 0.0
+
+    for i, frame in enumerate(frames):
+        # Work on a copy so draw_results never changes the source frame
+        image = frame.copy()
+        start = time.perf_counter()
+        if i < warmup:
+            run_frame(image, rank_bank, suit_bank, {stage: [] for stage in STAGES}, backend,
+                      executor=executor, scale=scale, external=external, suits=suits, cache=cache,
+                      fast_warp=fast_warp)
+            continue
+        if i == warmup and cache is not None:
+            cache.hits = cache.misses = 0
+        cards = run_frame(image, rank_bank, suit_bank, times, backend, executor=executor, scale=scale,
+                          external=external, suits=suits, cache=cache, fast_warp=fast_warp)
+        elapsed = elapsed + time.perf_counter() - start
+        num_frames = num_frames + 1
+        num_cards = num_cards + len(cards)
+
+    report = summarize(times, num_frames, num_cards, elapsed)
+    if cache is not None:
+        report['cache_hits'] = cache.hits
+        report['cache_misses'] = cache.misses
+        report['cache_hit_rate'] = cache.hit_rate()
+    return report
+
+
+def benchmark_pool(frames, num_workers, backend='absdiff', warmup=0):
+    """Times a FrameBus.Detection_pool with num_workers processes over an
+    iterable of frames. Reports throughput and the latency from submitting a
+    frame to getting its result back. Returns a report dictionary."""
+
+    # Decode everything up front so file reading is not timed
+    frames = list(frames)
+    pool = FrameBus.Detection_pool(frames[0].shape, num_workers, backend=backend)
+    submitted = {}
+    latencies = []
+    num_frames = 0
+    num_cards = 0
+
+    def drain(block):
+        nonlocal num_frames, num_cards
+        result = pool.get(timeout=None if block else 0)
+        if result is None:
+            return False
+        seq, timestamp, cards = result
+        start_time = submitted.pop(seq)
+        if seq >= warmup:
+            latencies.append(time.perf_counter() - start_time)
+            num_frames = num_frames + 1
+            num_cards = num_cards + len(cards or [])
+        return True
+
+    try:
+        # Warm up one frame at a time, so worker start-up doesn't count
+        for seq, frame in enumerate(frames[:warmup]):
+            submitted[seq] = time.perf_counter()
+            pool.submit(frame, seq)
+            drain(True)
+
+        start = time.perf_counter()
+        for seq, frame in enumerate(frames[warmup:], warmup):
+            # Keep every slot busy, collecting results whenever none is free
+            while pool.free_slots.empty():
+                drain(True)
+            submitted[seq] = time.perf_counter()
+            pool.submit(frame, seq)
+            while drain(False):
+                pass
+        while submitted:
+            drain(True)
+        elapsed = time.perf_counter() - start
+    finally:
+        pool.close()
+
+    report = summarize({'end_to_end': latencies}, num_frames, num_cards, elapsed)
+    report['workers'] = num_workers
+    return report
+
+
+def benchmark_tracker(frames, rank_bank, suit_bank, backend='absdiff', warmup=0):
+    """Times CardTracker.Card_tracker over an iterable of frames, which only
+    re-detects cards where the frame changed. Returns a report dictionary
+    that also counts full, region and idle frames."""
+
+    tracker = CardTracker.Card_tracker(rank_bank, suit_bank, backend)
+    times = {'tracker': []}
+    num_frames = 0
+    num_cards = 0
+    elapsed = 0.0
+
+    for i, frame in enumerate(frames):
+        start = time.perf_counter()
+        cards = tracker.update(frame)
+        end = time.perf_counter()
+        if i < warmup:
+            continue
+        times['tracker'].append(end - start)
+        elapsed = elapsed + end - start
+        num_frames = num_frames + 1
+        num_cards = num_cards + len(cards)
+
+    report = summarize(times, num_frames, num_cards, elapsed)
+    report['full_detections'] = tracker.full_detections
+    report['region_detections'] = tracker.region_detections
+    report['idle_frames'] = tracker.idle_frames
+    return report
+
+
+def synthetic_sweep(card_counts, resolutions, num_frames, rank_bank, suit_bank, backend='absdiff', seed=0,
+                    scale=1, external=False, suits=True, fast_warp=False):
+    """Benchmarks the preprocess_image -> find_cards -> preprocess_card ->
+    match_card pipeline on synthetic scenes for every combination of card
+    count and resolution. Contours are searched for on frames shrunk by
+    scale; 'auto' picks the scale that brings each resolution down to 720
+    lines, which the card area limits are set for. external is passed on to
+    find_cards, suits to match_cards and fast_warp to preprocess_cards.
+    Returns a list of
+    report dictionaries, each with throughput, stage latencies and
+    detection accuracy."""
+
+    reports = []
+    for resolution in resolutions:
+        frame_scale = resolution[1] / 720 if scale == 'auto' else scale
+        for num_cards in card_counts:
+            generator = SyntheticTable.Table_generator(seed=seed)
+            scenes = [generator.scene(num_cards, resolution) for i in range(num_frames)]
+
+            times = {stage: [] for stage in STAGES}
+            totals = np.zeros(4, dtype=int)
+            detected = 0
+            elapsed = 0.0
+            for image, labels in scenes:
+                start = time.perf_counter()
+                cards = run_frame(image, rank_bank, suit_bank, times, backend, draw=False, scale=frame_scale,
+                                  external=external, suits=suits, fast_warp=fast_warp)
+                elapsed = elapsed + time.perf_counter() - start
+                detected = detected + len(cards)
+                totals = totals + SyntheticTable.score_detections(cards, labels)
+
+            report = summarize(times, num_frames, detected, elapsed)
+            truth = num_cards * num_frames
+            found, rank_correct, suit_correct, false_positives = totals
+            report.update({
+                'resolution': '%dx%d' % resolution,
+                'cards_in_scene': num_cards,
+                'scale': frame_scale,
+                'recall': found / truth if truth else 0.0,
+                'rank_accuracy': rank_correct / truth if truth else 0.0,
+                'suit_accuracy': suit_correct / truth if truth else 0.0,
+                'false_positives': int(false_positives),
+            })
+            reports.append(report)
+    return reports
+
+
+def warp_parity(card_counts, resolution, num_frames, rank_bank, suit_bank, backend='absdiff', seed=0):
+    """Preprocesses every card found in synthetic scenes twice, once with
+    the corner-only warp and once by flattening the whole card, and matches
+    both. Returns a report dictionary with the number of cards, how many of
+    them got a different rank or suit, and how many ranks and suits each
+    path got right."""
+
+    correct = {'corner': np.zeros(2, dtype=int), 'flat': np.zeros(2, dtype=int)} # Ranks and suits right
+    num_found = 0
+    changed = 0
+    generator = SyntheticTable.Table_generator(seed=seed)
+    for num_cards in card_counts:
+        for i in range(num_frames):
+            image, labels = generator.scene(num_cards, resolution)
+            pre_proc = Cards.preprocess_image(image)
+            cnts_sort, cnt_is_card, cnt_corners = Cards.find_cards(pre_proc)
+            corner_cards = Cards.preprocess_cards(cnts_sort, cnt_is_card, image, cnt_corners=cnt_corners,
+                                                  fast_warp=True)
+            flat_cards = [Cards.preprocess_card(cnts_sort[j], image, cnt_corners[j])
+                          for j in range(len(cnts_sort)) if cnt_is_card[j] == 1]
+
+            for path, cards in [('corner', corner_cards), ('flat', flat_cards)]:
+                matches = Cards.match_cards(cards, rank_bank, suit_bank, backend)
+                for card, (rank_name, suit_name, rank_diff, suit_diff) in zip(cards, matches):
+                    card.best_rank_match, card.best_suit_match = rank_name, suit_name
+                found, rank_correct, suit_correct, false_positives = SyntheticTable.score_detections(cards, labels)
+                correct[path] = correct[path] + [rank_correct, suit_correct]
+
+            num_found = num_found + len(corner_cards)
+            for a, b in zip(corner_cards, flat_cards):
+                if (a.best_rank_match, a.best_suit_match) != (b.best_rank_match, b.best_suit_match):
+                    changed = changed + 1
+
+    return {'resolution': '%dx%d' % resolution, 'seed': seed, 'cards': num_found, 'changed': changed,
+            'corner_rank_correct': int(correct['corner'][0]), 'corner_suit_correct': int(correct['corner'][1]),
+            'flat_rank_correct': int(correct['flat'][0]), 'flat_suit_correct': int(correct['flat'][1])}
+
+
+def print_parity(report):
+    """Prints the result of a warp parity check."""
+
+    print("Seed %d, %s: %d cards, %d with a different result"
+          % (report['seed'], report['resolution'], report['cards'], report['changed']))
+    print("Corner warp: %d ranks, %d suits correct" % (report['corner_rank_correct'], report['corner_suit_correct']))
+    print("Flattener:   %d ranks, %d suits correct" % (report['flat_rank_correct'], report['flat_suit_correct']))
+
+
+def still_table_video(path, num_cards=8, num_frames=200, seed=0):
+    """Writes a video of one synthetic scene that never changes, for
+    Assistant to replay as a camera. Returns path."""
+
+    import cv2
+    image, labels = SyntheticTable.Table_generator(seed=seed).scene(num_cards)
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), Assistant.FRAME_RATE,
+                             (image.shape[1], image.shape[0]))
+    for i in range(num_frames):
+        writer.write(image)
+    writer.release()
+    return path
+
+
+def scan_check(source, modes=SCAN_MODES, scan_seconds=SCAN_CHECK_SECONDS):
+    """Runs one Assistant scan of source, which should show a still table,
+    in each detection mode. Returns a list of report dictionaries with the
+    scan time, whether the scan ended early and the cards it found."""
+
+    reports = []
+    for mode, extra in modes.items():
+        options = Assistant.parse_args(['--camera', source, '--headless', '--scan-seconds', str(scan_seconds)]
+                                       + extra)
+        assistant = Assistant.Assistant(options).start()
+        try:
+            # Wait for everything to be loaded, so only the scan is timed
+            assistant.videostream, assistant.banks, assistant.pool
+            start = time.monotonic()
+            player_cards, dealer_cards = assistant.detect_cards(scan_seconds)
+            elapsed = time.monotonic() - start
+        finally:
+            assistant.stop()
+        reports.append({'mode': mode, 'seconds': elapsed, 'early': elapsed < scan_seconds - 1,
+                        'player': player_cards, 'dealer': dealer_cards})
+    return reports
+
+
+def print_scan_check(reports):
+    """Prints the result of a scan check, one row per detection mode."""
+
+    print("%-8s %7s %6s  %s" % ('mode', 'seconds', 'early', 'cards (player / dealer)'))
+    for r in reports:
+        print("%-8s %7.1f %6s  %s / %s" % (r['mode'], r['seconds'], 'yes' if r['early'] else 'NO',
+                                           ' '.join(r['player']), ' '.join(r['dealer'])))
+
+
+def print_sweep(reports):
+    """Prints the results of a synthetic sweep, one row per configuration."""
+
+    print("%-11s %5s %9s %9s %8s %7s %7s %4s" % ('resolution', 'cards', 'frames/s', 'cards/s',
+                                                 'recall', 'rank', 'suit', 'FP'))
+    for r in reports:
+        print("%-11s %5d %9.1f %9.1f %7.1f%% %6.1f%% %6.1f%% %4d" % (
+            r['resolution'], r['cards_in_scene'], r['frames_per_sec'], r['cards_per_sec'],
+            100 * r['recall'], 100 * r['rank_accuracy'], 100 * r['suit_accuracy'], r['false_positives']))
+
+
+def parse_resolution(text):
+    """Parses a WIDTHxHEIGHT string into a (width, height) tuple."""
+
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the card detection pipeline on recorded frames.")
+    parser.add_argument('source', nargs='?', help="video file or directory of images to replay")
+    parser.add_argument('--synthetic', action='store_true', help="sweep synthetic scenes instead of replaying a source")
+    parser.add_argument('--cards', default='1,2,4,6,8,10', help="card counts to sweep with --synthetic")
+    parser.add_argument('--resolutions', default='1280x720', help="resolutions to sweep with --synthetic")
+    parser.add_argument('--seed', type=int, default=0, help="random seed for --synthetic")
+    parser.add_argument('--scan-check', action='store_true', help="check that Assistant scans of a still table end early")
+    parser.add_argument('--parity', action='store_true', help="with --synthetic, compare the corner warp with full flattening")
+    parser.add_argument('--frames', type=int, default=None, help="maximum number of frames to process")
+    parser.add_argument('--warmup', type=int, default=5, help="frames processed before timing starts")
+    parser.add_argument('--loop', action='store_true', help="replay the source until --frames is reached")
+    parser.add_argument('--backend', default='absdiff', choices=Cards.MATCH_BACKENDS, help="template matching backend")
+    parser.add_argument('--workers', type=int, default=0, help="run the pipeline in this many worker processes")
+    parser.add_argument('--card-threads', type=int, default=0, help="preprocess the cards of a frame in this many threads")
+    parser.add_argument('--tracker', action='store_true', help="detect incrementally with CardTracker")
+    parser.add_argument('--scale', default='1', help="find contours on frames shrunk by this factor ('auto' with --synthetic)")
+    parser.add_argument('--external', action='store_true', help="only retrieve outermost contours in find_cards")
+    parser.add_argument('--fast-warp', action='store_true', help="warp only the card corners instead of flattening whole cards")
+    parser.add_argument('--rank-only', action='store_true', help="match ranks only, leaving suits Unknown")
+    parser.add_argument('--cache', action='store_true', help="reuse matches of unchanged cards with CardCache")
+    parser.add_argument('--json', default=None, help="also write the report to this JSON file")
+    args = parser.parse_args()
+    scale = args.scale if args.scale == 'auto' and args.synthetic else float(args.scale)
+
+    if args.scan_check:
+        with tempfile.TemporaryDirectory() as directory:
+            source = args.source or still_table_video(os.path.join(directory, 'still.avi'), seed=args.seed)
+            reports = scan_check(source)
+        print_scan_check(reports)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(reports, f, indent=2)
+        sys.exit(0 if all(r['early'] for r in reports) else 1)
+
+    if args.synthetic and args.parity:
+        rank_bank, suit_bank = load_banks()
+        report = warp_parity([int(n) for n in args.cards.split(',')],
+                             parse_resolution(args.resolutions.split(',')[0]), args.frames or 20,
+                             rank_bank, suit_bank, args.backend, args.seed)
+        print_parity(report)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(report, f, indent=2)
+        return
+
+    if args.synthetic:
+        rank_bank, suit_bank = load_banks()
+        reports = synthetic_sweep([int(n) for n in args.cards.split(',')],
+                                  [parse_resolution(r) for r in args.resolutions.split(',')],
+                                  args.frames or 20, rank_bank, suit_bank, args.backend, args.seed, scale,
+                                  args.external, not args.rank_only, args.fast_warp)
+        print_sweep(reports)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(reports, f, indent=2)
+        return
+
+    if args.source is None:
+        parser.error("a source is needed unless --synthetic is given")
+    if args.loop and args.frames is None:
+        parser.error("--loop needs --frames")
+
+    rank_bank, suit_bank = load_banks()
+    source = VideoStream.FileVideoStream(args.source, loop=args.loop)
+    cache = CardCache.Identity_cache() if args.cache else None
+    max_frames = None if args.frames is None else args.frames + args.warmup
+    if args.tracker:
+        report = benchmark_tracker(source.frames(max_frames), rank_bank, suit_bank, args.backend, args.warmup)
+    elif args.workers > 0:
+        report = benchmark_pool(source.frames(max_frames), args.workers, args.backend, args.warmup)
+    elif args.card_threads > 0:
+        with ThreadPoolExecutor(args.card_threads) as executor:
+            report = benchmark(source.frames(max_frames), rank_bank, suit_bank, args.backend, args.warmup,
+                               executor, scale, args.external, not args.rank_only, cache, args.fast_warp)
+    else:
+        report = benchmark(source.frames(max_frames), rank_bank, suit_bank, args.backend, args.warmup,
+                           scale=scale, external=args.external, suits=not args.rank_only, cache=cache,
+                           fast_warp=args.fast_warp)
+    report['source'] = args.source
+    report['backend'] = args.backend
+
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
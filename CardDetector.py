@@ -4,7 +4,13 @@ import time
 import os
 import Cards
 import VideoStream
-from collections import defaultdict
+import CardCache
+import ConfidenceAggregator
+import Preview
+import Metrics
+import Profiler
+import TemplateBank
+from concurrent.futures import ThreadPoolExecutor
 
 # Shared variables for player and dealer cards
 detected_player_cards = []
@@ -33,11 +39,11 @@ def convert_rank(rank):
     return rank_map.get(rank, rank)
 
 def get_best_cards(cards_confidence):
-    """Get ranks with the highest confidence scores."""
+    """Get ranks with the highest confidence scores from a zone's Rank_stats."""
     best_cards = [
-        (convert_rank(rank), max(confidences))
-        for rank, confidences in cards_confidence.items()
-        if confidences and rank != "Unknown"
+        (convert_rank(rank), stats.max)
+        for rank, stats in cards_confidence.items()
+        if stats.count and rank != "Unknown"
     ]
     return [rank for rank, _ in best_cards]
 
@@ -47,6 +53,14 @@ def main():
     IM_HEIGHT = 720
     FRAME_RATE = 10
     CAMERA_INDEX = 1  # Set your camera index here (0 for default camera, 1 for external camera)
+    CARD_THREADS = 0  # Threads processing the cards of one frame concurrently (0 = serial)
+    HEADLESS = Preview.is_headless(False)  # No window; keys come from stdin or signals (or set CARD_HEADLESS=1)
+    PREVIEW_EVERY = 1  # Show only every Nth frame in the preview window
+    PREVIEW_SCALE = 1.0  # Size of the preview relative to the camera frame
+    METRICS_FILE = os.environ.get('CARD_METRICS_FILE')  # Rewrite pipeline metrics to this file (.prom for Prometheus)
+    PROFILE_DIR = os.environ.get('CARD_PROFILE_DIR', '.')  # Where on-demand profiles are written
+    PROFILE_CONTROL = os.environ.get('CARD_PROFILE_CONTROL')  # Creating this file starts a profile
+    PROFILE_FORMAT = os.environ.get('CARD_PROFILE_FORMAT', Profiler.PROFILE_FORMAT)  # 'collapsed' (with the Cards stage) or 'pstats'
 
     # Variables for timing and font
     frame_rate_calc = 1
@@ -54,88 +68,141 @@ def main():
     font = cv2.FONT_HERSHEY_SIMPLEX
 
     # Initialize the video stream
-    videostream = VideoStream.VideoStream((IM_WIDTH, IM_HEIGHT), FRAME_RATE, 2, CAMERA_INDEX).start()
+    videostream = VideoStream.VideoStream((IM_WIDTH, IM_HEIGHT), FRAME_RATE, 2, CAMERA_INDEX, low_latency=True).start()
     time.sleep(1)
 
-    # Load card rank and suit images
-    path = os.path.dirname(os.path.abspath(__file__))
-    train_ranks = Cards.load_ranks(path + '/Card_Imgs/')
-    train_suits = Cards.load_suits(path + '/Card_Imgs/')
+    # Map the card rank and suit templates from the template bank
+    rank_bank, suit_bank = TemplateBank.load_banks()
+
+    # Optionally preprocess the cards of a frame in parallel threads
+    card_executor = ThreadPoolExecutor(CARD_THREADS) if CARD_THREADS > 0 else None
+
+    # Reuse the match of cards that haven't moved or changed since they were last matched
+    card_cache = CardCache.Identity_cache()
+
+    # Optionally time the pipeline and the camera, and export the metrics
+    metrics_exporter = None
+    if METRICS_FILE:
+        Metrics.instrument_cards()
+        Metrics.instrument_stream(videostream)
+        metrics_exporter = Metrics.Exporter(METRICS_FILE).start()
+
+    # Profile the next frames on 'p', SIGUSR2 or when the control file appears
+    profiler = Profiler.Frame_profiler(PROFILE_DIR, fmt=PROFILE_FORMAT, control_file=PROFILE_CONTROL).listen()
 
     # Scanning and card detection variables
     cam_quit = False
     is_scanning = False
     scan_start_time = 0
-    scan_duration = 10  # seconds
+    scan_duration = 10  # seconds, at most
+    stable_frames = ConfidenceAggregator.STABLE_FRAMES  # Stable frames that end a scan early
 
     global detected_player_cards, detected_dealer_cards
-    dealer_confidence = defaultdict(list)
-    player_confidence = defaultdict(list)
+    aggregator = ConfidenceAggregator.Confidence_aggregator(['dealer', 'player'], stable_frames)
+    scan_stable = False
 
-    print("Press 's' to start a scan or 'q' to quit")
+    # Preview window, or stdin and signal input when running headless
+    preview = Preview.Preview("Card Detector", HEADLESS, PREVIEW_EVERY, PREVIEW_SCALE)
+    if HEADLESS:
+        print("Running headless. Type 's' and Enter (or send SIGUSR1) to start a scan, 'q' to quit")
+    else:
+        print("Press 's' to start a scan or 'q' to quit")
+    print("Press 'p' (or send SIGUSR2) to profile the next frames")
+
+    last_seq = 0
 
     while not cam_quit:
-        image = videostream.read()
+        # Wait for a frame that hasn't been processed yet. Results are only
+        # drawn on frames the preview shows, on a copy taken out of the
+        # capture ring.
+        new_frame = videostream.read_new(last_seq, timeout=0.1, copy=False)
+        if new_frame is None:
+            key = preview.poll_key()
+            if key == "q" or preview.quit:
+                cam_quit = True
+            continue
+        last_seq, _, image = new_frame
         t1 = cv2.getTickCount()
+        profiler.frame_start()
+        cards_in_view = 0
+        show = preview.due()
+        display = image.copy() if show else None
 
         if is_scanning:
             elapsed_time = time.time() - scan_start_time
 
-            if elapsed_time >= scan_duration:
+            if elapsed_time >= scan_duration or scan_stable:
                 # Scanning complete
                 is_scanning = False
-                detected_dealer_cards = get_best_cards(dealer_confidence)
-                detected_player_cards = get_best_cards(player_confidence)
+                detected_dealer_cards = get_best_cards(aggregator.stats['dealer'])
+                detected_player_cards = get_best_cards(aggregator.stats['player'])
 
+                if scan_stable:
+                    print(f"\nCards stable after {elapsed_time:.1f} s")
                 print("\nDealer's cards:", ' '.join(sorted(detected_dealer_cards)))
                 print("Player's cards:", ' '.join(sorted(detected_player_cards)))
 
-                dealer_confidence.clear()
-                player_confidence.clear()
+                aggregator = ConfidenceAggregator.Confidence_aggregator(['dealer', 'player'], stable_frames)
+                scan_stable = False
                 print("\nPress 's' to start another scan or 'q' to quit")
             else:
                 # Preprocess image and detect cards
                 pre_proc = Cards.preprocess_image(image)
-                cnts_sort, cnt_is_card = Cards.find_cards(pre_proc)
+                cnts_sort, cnt_is_card, cnt_corners = Cards.find_cards(pre_proc)
 
                 if cnts_sort:
-                    for i, is_card in enumerate(cnt_is_card):
-                        if is_card:
-                            card = Cards.preprocess_card(cnts_sort[i], image)
-                            card.best_rank_match, _, rank_diff, _ = Cards.match_card(card, train_ranks, train_suits)
-                            confidence = 1.0 / (rank_diff + 1)
-                            centroid_y = np.mean(card.contour[:, :, 1])
-
-                            # Assign confidence to dealer or player based on card position
-                            if centroid_y < IM_HEIGHT / 2:
-                                dealer_confidence[card.best_rank_match].append(confidence)
-                            else:
-                                player_confidence[card.best_rank_match].append(confidence)
-                            image = Cards.draw_results(image, card)
-
+                    cards = Cards.preprocess_cards(cnts_sort, cnt_is_card, image, card_executor, cnt_corners,
+                                                   suits=False)
+                    matches = card_cache.match_cards(cards, rank_bank, suit_bank, suits=False)
+                    cards_in_view = len(cards)
+                    Metrics.observe('cards_per_frame', cards_in_view, Metrics.COUNT_BOUNDS)
+                    for card, (rank_name, _, rank_diff, _) in zip(cards, matches):
+                        card.best_rank_match = rank_name
+                        confidence = 1.0 / (rank_diff + 1)
+                        centroid_y = np.mean(card.contour[:, :, 1])
+
+                        # Assign confidence to dealer or player based on card position
+                        zone = 'dealer' if centroid_y < IM_HEIGHT / 2 else 'player'
+                        aggregator.add(zone, card.best_rank_match, confidence)
+
+                        # Only the overlay shows suits, so match them just for drawing
+                        if show:
+                            Cards.match_suit(card, suit_bank)
+                            display = Cards.draw_results(display, card)
+
+                scan_stable = aggregator.end_frame()
                 remaining_time = int(scan_duration - elapsed_time)
-                cv2.putText(image, f"Scanning... {remaining_time}s", (10, 26), font, 0.7, (255, 0, 255), 2, cv2.LINE_AA)
-        else:
-            cv2.putText(image, "Press 's' to start scanning", (10, 26), font, 0.7, (255, 0, 255), 2, cv2.LINE_AA)
-
-        # Display the processed image
-        cv2.imshow("Card Detector", image)
+                if show:
+                    cv2.putText(display, f"Scanning... {remaining_time}s", (10, 26), font, 0.7, (255, 0, 255), 2, cv2.LINE_AA)
+        elif show:
+            cv2.putText(display, "Press 's' to start scanning", (10, 26), font, 0.7, (255, 0, 255), 2, cv2.LINE_AA)
+
+        # Display the processed image, with the frame rate of the last frame
+        if show:
+            cv2.putText(display, f"FPS: {frame_rate_calc:.1f}", (10, 52), font, 0.7, (255, 0, 255), 2, cv2.LINE_AA)
+            preview.show(display)
         t2 = cv2.getTickCount()
         frame_rate_calc = 1 / ((t2 - t1) / freq)
+        Metrics.observe('frame_seconds', (t2 - t1) / freq)
+        profiler.frame_end(cards_in_view)
 
         # Key handling
-        key = cv2.waitKey(1) & 0xFF
-        if key == ord("s") and not is_scanning:
+        key = preview.poll_key()
+        if key == "s" and not is_scanning:
             is_scanning = True
             scan_start_time = time.time()
             reset_detected_cards()
             print("\nStarting scan...")
-        elif key == ord("q"):
+        elif key == "p":
+            profiler.request()
+        elif key == "q" or preview.quit:
             cam_quit = True
 
     # Cleanup
-    cv2.destroyAllWindows()
+    preview.close()
     videostream.stop()
+    if metrics_exporter is not None:
+        metrics_exporter.stop()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,152 @@
+### Incremental card detection by tracking cards across frames ###
+#
+# Cards on a blackjack table barely move once they are dealt. The tracker
+# keeps every identified card between frames and only looks for cards again
+# where a MotionGate saw the picture change and settle, or on every frame
+# when a periodic full detection is due. On a steady table a frame costs one
+# small difference image instead of the whole Cards pipeline. A settled
+# change can be confirmed by detecting its regions again on the next few
+# still frames, so callers that need several independent matches get them.
+
+import numpy as np
+import cv2
+import Cards
+import MotionGate
+
+# Frames between full-frame detections, which catch slow drifts that never
+# show up as a change between two consecutive frames
+REDETECT_EVERY = 30
+
+# Downscale factor of the difference image used to find changed regions
+CHANGE_SCALE = 8
+
+# Gray level difference (on the downscaled image) that counts as a change
+CHANGE_THRESH = 20
+
+# Margin added around changed regions before detection, in full resolution
+# pixels, so a card that is only partly changed is still seen whole
+REGION_MARGIN = int(np.sqrt(Cards.CARD_MAX_AREA))
+
+# Above this fraction of the frame, changed regions are merged into one
+# full-frame detection
+FULL_FRAME_FRACTION = 0.5
+
+
+class Card_tracker:
+    """Keeps the cards identified in earlier frames and re-detects cards
+    only in regions of the frame that changed. update() returns the current
+    cards as Query_card objects, like Cards.process_frame does. If suits is
+    False, only ranks are matched. The regions of every settled change are
+    detected again on the next confirm_frames still frames."""
+
+    def __init__(self, train_ranks, train_suits, backend='absdiff', redetect_every=REDETECT_EVERY,
+                 change_thresh=CHANGE_THRESH, executor=None, suits=True, confirm_frames=0):
+        self.rank_bank = Cards.as_bank(train_ranks)
+        self.suit_bank = Cards.as_bank(train_suits)
+        self.backend = backend
+        self.redetect_every = redetect_every
+        self.executor = executor
+        self.suits = suits
+        self.confirm_frames = confirm_frames
+        # Finds the regions that changed and have settled again
+        self.gate = MotionGate.Motion_gate(CHANGE_SCALE, change_thresh, margin=REGION_MARGIN)
+
+        self.cards = [] # Query_card objects of the cards being tracked
+        self.frames_since_full = 0
+        self.detected = False # Detection ran on the last frame
+        self.confirm_regions = None # Regions to detect again on still frames, None for the whole frame
+        self.confirm_left = 0 # Still frames they are still to be detected on
+
+        # Counters for how much detection work the tracker saved
+        self.frames = 0
+        self.full_detections = 0
+        self.region_detections = 0
+        self.idle_frames = 0
+
+    def update(self, image):
+        """Processes one camera image and returns the list of cards on it.
+        While something moves over the table, the cards from before are
+        returned unchanged."""
+
+        self.frames = self.frames + 1
+        img_h, img_w = image.shape[:2]
+
+        if self.gate.update(image):
+            regions = self.gate.regions
+            if sum(w * h for x, y, w, h in regions) > FULL_FRAME_FRACTION * img_w * img_h:
+                regions = [(0, 0, img_w, img_h)]
+            self.confirm_regions = regions
+            self.confirm_left = self.confirm_frames
+        elif self.gate.state == MotionGate.STILL and self.confirm_left > 0:
+            regions = self.confirm_regions or [(0, 0, img_w, img_h)]
+            self.confirm_left = self.confirm_left - 1
+        elif self.gate.state == MotionGate.STILL and self.frames_since_full >= self.redetect_every:
+            regions = [(0, 0, img_w, img_h)]
+        else:
+            regions = []
+
+        self.detected = len(regions) != 0
+        if not self.detected:
+            self.idle_frames = self.idle_frames + 1
+            self.frames_since_full = self.frames_since_full + 1
+            return self.cards
+
+        if regions == [(0, 0, img_w, img_h)]:
+            self.full_detections = self.full_detections + 1
+            self.frames_since_full = 0
+        else:
+            self.region_detections = self.region_detections + 1
+            self.frames_since_full = self.frames_since_full + 1
+
+        for region in regions:
+            self.detect_region(image, region)
+        return self.cards
+
+    def confirm(self, frames):
+        """Detects the whole frame again on the next frames still frames,
+        e.g. when a caller starts collecting evidence on a table that has
+        been steady for a while."""
+
+        self.confirm_regions = None
+        self.confirm_left = frames
+
+    def detect_region(self, image, region):
+        """Runs the detection pipeline on one region of the frame. Tracked
+        cards inside the region are replaced by what is found there."""
+
+        x, y, w, h = region
+        img_h, img_w = image.shape[:2]
+        thresh = Cards.preprocess_image(image, region)
+        cnts_sort, cnt_is_card, cnt_corners = Cards.find_cards(thresh)
+
+        # Move contours to frame coordinates. Contours touching an edge of the
+        # region that isn't an edge of the frame may be cut off, so they are
+        # left to the region that holds the whole card.
+        contours = []
+        corners = []
+        for i in range(len(cnts_sort)):
+            if cnt_is_card[i] != 1:
+                continue
+            cx, cy, cw, ch = cv2.boundingRect(cnts_sort[i])
+            if ((cx == 0 and x > 0) or (cy == 0 and y > 0)
+                    or (cx + cw >= w and x + w < img_w) or (cy + ch >= h and y + h < img_h)):
+                continue
+            contours.append(cnts_sort[i] + np.array([x, y], dtype=cnts_sort[i].dtype))
+            corners.append(cnt_corners[i] + np.float32([x, y]))
+
+        cards = Cards.preprocess_cards(contours, [1] * len(contours), image, self.executor, corners, self.suits)
+        matches = Cards.match_cards(cards, self.rank_bank, self.suit_bank, self.backend, suits=self.suits)
+        for qCard, (rank_name, suit_name, rank_diff, suit_diff) in zip(cards, matches):
+            qCard.best_rank_match, qCard.best_suit_match = rank_name, suit_name
+            qCard.rank_diff, qCard.suit_diff = rank_diff, suit_diff
+
+        # Tracked cards lying wholly inside the region were either found again
+        # or are gone. Cards only partly inside it were skipped above, so they
+        # keep their identity.
+        kept = []
+        for qCard in self.cards:
+            cx, cy, cw, ch = cv2.boundingRect(qCard.contour)
+            if not (cx >= x and cy >= y and cx + cw <= x + w and cy + ch <= y + h):
+                kept.append(qCard)
+        self.cards = kept + cards
+
@@ -24,11 +24,40 @@ SUIT_HEIGHT = 100
 RANK_DIFF_MAX = 2000
 SUIT_DIFF_MAX = 700
 
+# Names of the rank and suit train images in Card_Imgs/, in bank order
+RANK_NAMES = ['Ace','Two','Three','Four','Five','Six','Seven',
+              'Eight','Nine','Ten','Jack','Queen','King']
+SUIT_NAMES = ['Spades','Diamonds','Clubs','Hearts']
+
 CARD_MAX_AREA = 120000
 CARD_MIN_AREA = 25000
 
+# Size of the flattened card, and the zoom applied to its corner before the
+# rank and suit are read from it
+FLAT_WIDTH = 200
+FLAT_HEIGHT = 300
+CORNER_ZOOM = 4
+
+# Template matching backends accepted by match_cards.
+# 'absdiff' differences full uint8 images, 'packed' compares bit-packed
+# binary images (8 pixels per byte) with XOR and popcount, and 'coarse'
+# ranks templates on downscaled images and only differences the best
+# COARSE_TOP_K of them at full resolution.
+MATCH_BACKENDS = ('absdiff', 'packed', 'coarse')
+
+# Downscale factor and number of refined candidates for the 'coarse' backend
+COARSE_SCALE = 4
+COARSE_TOP_K = 3
+
+# Pixel level at or above which a rank or suit image counts as white
+# when it is bit-packed
+BINARY_THRESH = 128
+
 font = cv2.FONT_HERSHEY_SIMPLEX
 
+# Overlay label sprites rendered by label_sprite, by (text, color)
+_LABEL_SPRITES = {}
+
 ### Structures to hold query card and train card information ###
 
 class Query_card:
@@ -39,9 +68,10 @@ class Query_card:
         self.width, self.height = 0, 0 # Width and height of card
         self.corner_pts = [] # Corner points of card
         self.center = [] # Center point of card
-        self.warp = [] # 200x300, flattened, grayed, blurred image
+        self.warp = [] # 200x300, flattened, grayed, blurred image (only when flattened)
         self.rank_img = [] # Thresholded, sized image of card's rank
         self.suit_img = [] # Thresholded, sized image of card's suit
+        self.suit_region = [] # Thresholded suit half of the card corner, until the suit is isolated
         self.best_rank_match = "Unknown" # Best matched rank
         self.best_suit_match = "Unknown" # Best matched suit
         self.rank_diff = 0 # Difference between rank image and best matched train rank image
@@ -61,6 +91,23 @@ class Train_suits:
         self.img = [] # Thresholded, sized suit image loaded from hard drive
         self.name = "Placeholder"
 
+class Train_bank:
+    """Structure to store a set of train images stacked into one array, so
+    query cards can be differenced against every template at once. Built
+    from a list of Train_ranks or Train_suits objects, or from names and
+    ready-made stacks (e.g. memory-mapped by TemplateBank)."""
+
+    def __init__(self, train_list=None, names=None, imgs=None, packed=None, coarse=None,
+                 coarse_scale=COARSE_SCALE):
+        if train_list is not None:
+            names = [train.name for train in train_list]
+            imgs = np.stack([train.img for train in train_list])
+        self.names = list(names) # Names, in stack order
+        self.imgs = imgs # (N, height, width) image stack
+        self.packed = pack_images(imgs) if packed is None else packed # (N, height, ceil(width/8)) bit-packed binary stack
+        self.coarse_scale = coarse_scale # Downscale factor of the coarse stack
+        self.coarse = downscale_images(imgs, coarse_scale) if coarse is None else coarse # (N, height/4, width/4) low resolution stack
+
 ### Functions ###
 def load_ranks(filepath):
     """Loads rank images from directory specified by filepath. Stores
@@ -69,8 +116,7 @@ def load_ranks(filepath):
     train_ranks = []
     i = 0
     
-    for Rank in ['Ace','Two','Three','Four','Five','Six','Seven',
-                 'Eight','Nine','Ten','Jack','Queen','King']:
+    for Rank in RANK_NAMES:
         train_ranks.append(Train_ranks())
         train_ranks[i].name = Rank
         filename = Rank + '.jpg'
@@ -86,7 +132,7 @@ def load_suits(filepath):
     train_suits = []
     i = 0
     
-    for Suit in ['Spades','Diamonds','Clubs','Hearts']:
+    for Suit in SUIT_NAMES:
         train_suits.append(Train_suits())
         train_suits[i].name = Suit
         filename = Suit + '.jpg'
@@ -95,10 +141,22 @@ def load_suits(filepath):
 
     return train_suits
 
-def preprocess_image(image):
-    """Returns a grayed, blurred, and adaptively thresholded camera image."""
-
-    gray = cv2.cvtColor(image,cv2.COLOR_BGR2GRAY)
+def preprocess_image(image, roi=None, scale=1):
+    """Returns a grayed, blurred, and adaptively thresholded camera image.
+    If roi (x, y, w, h) is given, only that region of the image is
+    processed and returned, using the same threshold level as the full
+    image would. If scale is above 1, the image is shrunk by that factor
+    first, and find_cards must then be given the same scale."""
+
+    region = image
+    if roi is not None:
+        x, y, w, h = roi
+        region = image[y:y+h, x:x+w]
+    if scale != 1:
+        # Bilinear shrinking is cheap, and the blur below smooths it anyway
+        size = (max(int(round(region.shape[1] / scale)), 1), max(int(round(region.shape[0] / scale)), 1))
+        region = cv2.resize(region, size, interpolation=cv2.INTER_LINEAR)
+    gray = cv2.cvtColor(region,cv2.COLOR_BGR2GRAY)
     blur = cv2.GaussianBlur(gray,(5,5),0)
 
     # The best threshold level depends on the ambient lighting conditions.
@@ -111,59 +169,91 @@ def preprocess_image(image):
     # its intensity. The adaptive threshold is set at 50 (THRESH_ADDER) higher
     # than that. This allows the threshold to adapt to the lighting conditions.
     img_w, img_h = np.shape(image)[:2]
-    bkg_level = gray[int(img_h/100)][int(img_w/2)]
+    if roi is None and scale == 1:
+        bkg_level = gray[int(img_h/100)][int(img_w/2)]
+    else:
+        # Sample the same background pixel of the full image
+        bkg_pixel = image[int(img_h/100):int(img_h/100)+1, int(img_w/2):int(img_w/2)+1]
+        bkg_level = cv2.cvtColor(bkg_pixel,cv2.COLOR_BGR2GRAY)[0][0]
     thresh_level = bkg_level + BKG_THRESH
 
     retval, thresh = cv2.threshold(blur,thresh_level,255,cv2.THRESH_BINARY)
     
     return thresh
 
-def find_cards(thresh_image):
+def find_cards(thresh_image, scale=1, external=False):
     """Finds all card-sized contours in a thresholded camera image.
-    Returns the number of cards, and a list of card contours sorted
-    from largest to smallest."""
-
-    # Find contours and sort their indices by contour size
-    cnts, hier = cv2.findContours(thresh_image, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-    index_sort = sorted(range(len(cnts)), key=lambda i: cv2.contourArea(cnts[i]), reverse=True)
+    Returns a list of contours sorted from largest to smallest, an array
+    flagging which of them are cards, and a list holding the four
+    approximated corner points of each card (None for other contours).
+    If the image was shrunk by scale in preprocess_image, the card area
+    limits are shrunk to match and the card contours and corners are
+    mapped back to full resolution coordinates. If external is True, only outermost contours
+    are retrieved, which is cheaper on textured backgrounds."""
+
+    # Find contours. Only contours without a parent can be cards, so in
+    # external mode OpenCV doesn't need to build the hierarchy at all.
+    if external:
+        cnts, hier = cv2.findContours(thresh_image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    else:
+        cnts, hier = cv2.findContours(thresh_image, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
 
     # If there are no contours, do nothing
     if len(cnts) == 0:
-        return [], []
-    
-    # Otherwise, initialize empty sorted contour and hierarchy lists
-    cnts_sort = []
-    hier_sort = []
-    cnt_is_card = np.zeros(len(cnts), dtype=int)
+        return [], [], []
 
-    # Fill empty lists with sorted contour and sorted hierarchy. Now,
-    # the indices of the contour list still correspond with those of
-    # the hierarchy list. The hierarchy array can be used to check if
-    # the contours have parents or not.
-    for i in index_sort:
-        cnts_sort.append(cnts[i])
-        hier_sort.append(hier[0][i])
+    # Compute every contour area once and sort the contours by it
+    areas = np.array([cv2.contourArea(cnt) for cnt in cnts])
+    index_sort = np.argsort(-areas, kind='stable')
+    cnts_sort = [cnts[i] for i in index_sort]
+    cnt_is_card = np.zeros(len(cnts), dtype=int)
+    cnt_corners = [None] * len(cnts)
 
     # Determine which of the contours are cards by applying the
     # following criteria: 1) Smaller area than the maximum card size,
     # 2), bigger area than the minimum card size, 3) have no parents,
-    # and 4) have four corners
-
-    for i in range(len(cnts_sort)):
-        size = cv2.contourArea(cnts_sort[i])
-        peri = cv2.arcLength(cnts_sort[i], True)
-        approx = cv2.approxPolyDP(cnts_sort[i], 0.01 * peri, True)
-        
-        if ((size < CARD_MAX_AREA) and (size > CARD_MIN_AREA)
-                and (hier_sort[i][3] == -1) and (len(approx) == 4)):
-            cnt_is_card[i] = 1
-
-    return cnts_sort, cnt_is_card
-
-
-def preprocess_card(contour, image):
+    # and 4) have four corners. The cheap tests run on all contours at
+    # once, so the polygon approximation only runs on the few that pass.
+    max_area = CARD_MAX_AREA / (scale * scale)
+    min_area = CARD_MIN_AREA / (scale * scale)
+    areas_sort = areas[index_sort]
+    candidates = (areas_sort < max_area) & (areas_sort > min_area)
+    if not external:
+        candidates = candidates & (hier[0][index_sort, 3] == -1)
+
+    for i in np.flatnonzero(candidates):
+        cnt = cnts_sort[i]
+        if scale != 1:
+            # Edges of a shrunk card are jagged, its convex hull isn't. The
+            # hull keeps the point order findContours gives, which flattener
+            # relies on for diamond oriented cards.
+            cnt = cv2.convexHull(cnt, clockwise=True)
+            size = cv2.contourArea(cnt)
+            if not (min_area < size < max_area):
+                continue
+        peri = cv2.arcLength(cnt, True)
+        approx = cv2.approxPolyDP(cnt, 0.01 * peri, True)
+        if len(approx) != 4:
+            continue
+
+        cnt_is_card[i] = 1
+        cnt_corners[i] = np.float32(approx)
+        if scale != 1:
+            # Map the card back to full resolution, to the centers of the
+            # pixels each shrunk pixel stands for
+            cnts_sort[i] = np.int32(cnt * scale + (scale - 1) / 2)
+            cnt_corners[i] = cnt_corners[i] * scale + (scale - 1) / 2
+
+    return cnts_sort, cnt_is_card, cnt_corners
+
+
+def preprocess_card(contour, image, corners=None, gray=None, suits=True):
     """Uses contour to find information about the query card. Isolates rank
-    and suit images from the card."""
+    and suit images from the card. The corner points find_cards already
+    approximated can be passed as corners. If a grayed copy of the image is
+    given as gray, only the card's corner is warped, straight into its
+    zoomed size, and the full card is never flattened. If suits is False,
+    the suit is not isolated until isolate_suit is called."""
 
     # Initialize new Query_card object
     qCard = Query_card()
@@ -171,9 +261,10 @@ def preprocess_card(contour, image):
     qCard.contour = contour
 
     # Find perimeter of card and use it to approximate corner points
-    peri = cv2.arcLength(contour, True)
-    approx = cv2.approxPolyDP(contour, 0.01 * peri, True)
-    pts = np.float32(approx)
+    if corners is None:
+        peri = cv2.arcLength(contour, True)
+        corners = cv2.approxPolyDP(contour, 0.01 * peri, True)
+    pts = np.float32(corners)
     qCard.corner_pts = pts
 
     # Find width and height of card's bounding rectangle
@@ -186,15 +277,18 @@ def preprocess_card(contour, image):
     cent_y = int(average[0][1])
     qCard.center = [cent_x, cent_y]
 
-    # Warp card into 200x300 flattened image using perspective transform
-    qCard.warp = flattener(image, pts, w, h)
+    if gray is None:
+        # Warp card into 200x300 flattened image using perspective transform
+        qCard.warp = flattener(image, pts, w, h)
 
-    # Grab corner of warped card image and do a 4x zoom
-    Qcorner = qCard.warp[0:CORNER_HEIGHT, 0:CORNER_WIDTH]
-    Qcorner_zoom = cv2.resize(Qcorner, (0, 0), fx=4, fy=4)
+        # Grab corner of warped card image and do a 4x zoom
+        Qcorner = qCard.warp[0:CORNER_HEIGHT, 0:CORNER_WIDTH]
+        Qcorner_zoom = cv2.resize(Qcorner, (0, 0), fx=CORNER_ZOOM, fy=CORNER_ZOOM)
+    else:
+        Qcorner_zoom = corner_warp(gray, pts, w, h)
 
     # Sample known white pixel intensity to determine good threshold level
-    white_level = Qcorner_zoom[15, int((CORNER_WIDTH * 4) / 2)]
+    white_level = Qcorner_zoom[15, int((CORNER_WIDTH * CORNER_ZOOM) / 2)]
     thresh_level = white_level - CARD_THRESH
     if thresh_level <= 0:
         thresh_level = 1
@@ -216,6 +310,23 @@ def preprocess_card(contour, image):
         Qrank_sized = cv2.resize(Qrank_roi, (RANK_WIDTH, RANK_HEIGHT), 0, 0)
         qCard.rank_img = Qrank_sized
 
+    qCard.suit_region = Qsuit
+    if suits:
+        isolate_suit(qCard)
+
+    return qCard
+
+
+def isolate_suit(qCard):
+    """Isolates the suit image of a query card from the suit region that
+    preprocess_card kept, if that wasn't done yet. Returns the suit image,
+    which is empty if no suit was found."""
+
+    if len(qCard.suit_img) != 0 or len(qCard.suit_region) == 0:
+        return qCard.suit_img
+    Qsuit = qCard.suit_region
+    qCard.suit_region = []
+
     # Find suit contour and bounding rectangle, isolate and find largest contour
     Qsuit_cnts, hier = cv2.findContours(Qsuit, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
     Qsuit_cnts = sorted(Qsuit_cnts, key=cv2.contourArea, reverse=True)
@@ -228,13 +339,18 @@ def preprocess_card(contour, image):
         Qsuit_sized = cv2.resize(Qsuit_roi, (SUIT_WIDTH, SUIT_HEIGHT), 0, 0)
         qCard.suit_img = Qsuit_sized
 
-    return qCard
+    return qCard.suit_img
 
 
-def match_card(qCard, train_ranks, train_suits):
+def match_card(qCard, train_ranks, train_suits, backend=None):
     """Finds best rank and suit matches for the query card. Differences
     the query card rank and suit images with the train rank and suit images.
-    The best match is the rank or suit image that has the least difference."""
+    The best match is the rank or suit image that has the least difference.
+    If a backend from MATCH_BACKENDS is given, the card is matched with
+    match_cards instead of the per-template loop."""
+
+    if backend is not None:
+        return match_cards([qCard], train_ranks, train_suits, backend)[0]
 
     best_rank_match_diff = 10000
     best_suit_match_diff = 10000
@@ -281,10 +397,273 @@ def match_card(qCard, train_ranks, train_suits):
 
     # Return the identiy of the card and the quality of the suit and rank match
     return best_rank_match_name, best_suit_match_name, best_rank_match_diff, best_suit_match_diff
+
+
+def as_bank(train):
+    """Returns train as a Train_bank. Lists of Train_ranks or Train_suits
+    objects are stacked, Train_bank objects are passed through."""
+
+    if isinstance(train, Train_bank):
+        return train
+    return Train_bank(train)
+
+
+def diff_stack(query_imgs, train_imgs):
+    """Differences a (Q, height, width) stack of query images against a
+    (T, height, width) stack of train images. Returns a (Q, T) array with
+    the same scores as int(np.sum(cv2.absdiff(query, train))/255)."""
+
+    diff = np.abs(query_imgs[:, None].astype(np.int16) - train_imgs[None].astype(np.int16))
+    return diff.sum(axis=(2, 3), dtype=np.int64) // 255
+
+
+def pack_images(imgs):
+    """Thresholds a stack of rank or suit images at BINARY_THRESH and packs
+    each row into bits, 8 pixels per byte."""
+
+    return np.packbits(np.asarray(imgs) >= BINARY_THRESH, axis=-1)
+
+
+# Number of set bits in every possible byte value, used when numpy has
+# no bitwise_count ufunc (numpy < 2.0)
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+def popcount_stack(query_bits, train_bits):
+    """XORs a (Q, height, bytes) stack of packed query images against a
+    (T, height, bytes) stack of packed train images and counts the set bits.
+    Returns a (Q, T) array holding the number of differing pixels, which
+    for binary 0/255 images equals the diff_stack score."""
+
+    xor = np.bitwise_xor(query_bits[:, None], train_bits[None])
+    if hasattr(np, 'bitwise_count'):
+        bits = np.bitwise_count(xor)
+    else:
+        bits = _POPCOUNT[xor]
+    return bits.sum(axis=(2, 3), dtype=np.int64)
+
+
+def downscale_images(imgs, scale=COARSE_SCALE):
+    """Shrinks every image of a (N, height, width) stack by scale with area
+    averaging. Returns a (N, height/scale, width/scale) stack."""
+
+    height, width = imgs.shape[1:3]
+    size = (max(width // scale, 1), max(height // scale, 1))
+    return np.stack([cv2.resize(img, size, interpolation=cv2.INTER_AREA) for img in imgs])
+
+
+def coarse_stack(query_imgs, bank, top_k=COARSE_TOP_K):
+    """Scores a stack of query images against a Train_bank coarse to fine.
+    Every template is scored on the downscaled images, then only the top_k
+    best candidates per query are differenced at full resolution. Returns
+    a (Q, T) array holding full resolution diff_stack scores for the
+    refined candidates and a value larger than any real score elsewhere."""
+
+    coarse_diffs = diff_stack(downscale_images(query_imgs, bank.coarse_scale), bank.coarse)
+    num_train = len(bank.imgs)
+    top_k = min(top_k, num_train)
+    if top_k < num_train:
+        candidates = np.argpartition(coarse_diffs, top_k - 1, axis=1)[:, :top_k]
+    else:
+        candidates = np.broadcast_to(np.arange(num_train), coarse_diffs.shape)
+
+    # Difference each query only against its own candidate templates
+    diff = np.abs(query_imgs[:, None].astype(np.int16) - bank.imgs[candidates].astype(np.int16))
+    fine_diffs = diff.sum(axis=(2, 3), dtype=np.int64) // 255
+
+    scores = np.full(coarse_diffs.shape, query_imgs[0].size + 1, dtype=np.int64)
+    np.put_along_axis(scores, candidates, fine_diffs, axis=1)
+    return scores
+
+
+def score_stack(query_imgs, bank, backend, top_k=COARSE_TOP_K):
+    """Scores a stack of query images against every image in a Train_bank
+    with the given backend. Returns a (Q, T) array of differences."""
+
+    if backend == 'absdiff':
+        return diff_stack(query_imgs, bank.imgs)
+    if backend == 'packed':
+        return popcount_stack(pack_images(query_imgs), bank.packed)
+    if backend == 'coarse':
+        return coarse_stack(query_imgs, bank, top_k)
+    raise ValueError("Unknown match backend %r, expected one of %s" % (backend, MATCH_BACKENDS))
+
+
+def match_cards(qCards, train_ranks, train_suits, backend='absdiff', top_k=COARSE_TOP_K, suits=True):
+    """Batched version of match_card. Scores the rank and suit images of all
+    query cards in a frame against every train image in one operation per
+    template stack. train_ranks and train_suits can be Train_bank objects or
+    the lists returned by load_ranks and load_suits, and backend is one of
+    MATCH_BACKENDS. top_k is the number of candidates the 'coarse' backend
+    refines at full resolution. Returns a list with one (rank name, suit
+    name, rank diff, suit diff) tuple per query card, in the same order as
+    qCards. RANK_DIFF_MAX and SUIT_DIFF_MAX always apply to full resolution
+    scores. If suits is False, only ranks are matched, train_suits may be
+    None and every suit is left as Unknown; match_suit can still match the
+    suit of a card later."""
+
+    rank_bank = as_bank(train_ranks)
+    results = [("Unknown", "Unknown", 10000, 10000)] * len(qCards)
+
+    if not suits:
+        valid = [i for i, qCard in enumerate(qCards) if len(qCard.rank_img) != 0]
+        if len(valid) == 0:
+            return results
+        rank_diffs = score_stack(np.stack([qCards[i].rank_img for i in valid]), rank_bank, backend, top_k)
+        best_ranks = np.argmin(rank_diffs, axis=1)
+        for j, i in enumerate(valid):
+            rank_diff = int(rank_diffs[j, best_ranks[j]])
+            rank_name = rank_bank.names[best_ranks[j]] if rank_diff < RANK_DIFF_MAX else "Unknown"
+            results[i] = (rank_name, "Unknown", rank_diff, 10000)
+        return results
+
+    suit_bank = as_bank(train_suits)
+
+    # Cards with no rank or suit image are left as Unknown, like in match_card
+    valid = [i for i, qCard in enumerate(qCards)
+             if (len(qCard.rank_img) != 0) and (len(qCard.suit_img) != 0)]
+    if len(valid) == 0:
+        return results
+
+    rank_diffs = score_stack(np.stack([qCards[i].rank_img for i in valid]), rank_bank, backend, top_k)
+    suit_diffs = score_stack(np.stack([qCards[i].suit_img for i in valid]), suit_bank, backend, top_k)
+
+    # argmin returns the first of equal scores, the same tie-break as the
+    # strict comparison in match_card
+    best_ranks = np.argmin(rank_diffs, axis=1)
+    best_suits = np.argmin(suit_diffs, axis=1)
+
+    for j, i in enumerate(valid):
+        rank_diff = int(rank_diffs[j, best_ranks[j]])
+        suit_diff = int(suit_diffs[j, best_suits[j]])
+        rank_name = rank_bank.names[best_ranks[j]] if rank_diff < RANK_DIFF_MAX else "Unknown"
+        suit_name = suit_bank.names[best_suits[j]] if suit_diff < SUIT_DIFF_MAX else "Unknown"
+        results[i] = (rank_name, suit_name, rank_diff, suit_diff)
+
+    return results
+
+
+def match_suit(qCard, train_suits, backend='absdiff', top_k=COARSE_TOP_K):
+    """Matches only the suit of a query card, isolating its suit image first
+    if preprocess_card skipped that. Sets and returns the card's best suit
+    match and suit difference."""
+
+    suit_name, suit_diff = "Unknown", 10000
+    suit_img = isolate_suit(qCard)
+    if len(suit_img) != 0:
+        suit_bank = as_bank(train_suits)
+        suit_diffs = score_stack(suit_img[np.newaxis], suit_bank, backend, top_k)[0]
+        best_suit = np.argmin(suit_diffs)
+        suit_diff = int(suit_diffs[best_suit])
+        if suit_diff < SUIT_DIFF_MAX:
+            suit_name = suit_bank.names[best_suit]
+
+    qCard.best_suit_match, qCard.suit_diff = suit_name, suit_diff
+    return suit_name, suit_diff
     
     
+def preprocess_cards(cnts_sort, cnt_is_card, image, executor=None, cnt_corners=None, suits=True,
+                     fast_warp=False):
+    """Runs preprocess_card on every contour find_cards flagged as a card,
+    reusing the corner points in cnt_corners if given, and isolating suits
+    only if suits is True. Cards are flattened whole, unless fast_warp is
+    True: then the image is grayed once for all cards and only the card
+    corners are warped, which is faster but doesn't give identical results
+    (see corner_warp). If an executor (e.g. a
+    concurrent.futures.ThreadPoolExecutor) is given, the cards are processed
+    concurrently; OpenCV releases the GIL while it warps, thresholds and
+    resizes. Returns the Query_card objects in contour order."""
+
+    indices = [i for i in range(len(cnts_sort)) if cnt_is_card[i] == 1]
+    contours = [cnts_sort[i] for i in indices]
+    if cnt_corners is None:
+        corners = [None] * len(indices)
+    else:
+        corners = [cnt_corners[i] for i in indices]
+    if len(contours) == 0:
+        return []
+
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if fast_warp else None
+    if executor is None or len(contours) < 2:
+        return [preprocess_card(contour, image, pts, gray, suits) for contour, pts in zip(contours, corners)]
+    return list(executor.map(preprocess_card, contours, [image] * len(contours), corners,
+                             [gray] * len(contours), [suits] * len(contours)))
+
+
+def process_frame(image, train_ranks, train_suits, backend='absdiff', executor=None, scale=1, suits=True,
+                  fast_warp=False):
+    """Runs the whole detection pipeline on one camera image. Cards are
+    preprocessed concurrently if an executor is given, searched for on an
+    image shrunk by scale, and only their corners are warped if fast_warp
+    is True. Returns a list of Query_card objects, one per card found,
+    with their best rank and suit matches and differences filled in. If
+    suits is False, only ranks are matched."""
+
+    pre_proc = preprocess_image(image, scale=scale)
+    cnts_sort, cnt_is_card, cnt_corners = find_cards(pre_proc, scale)
+    cards = preprocess_cards(cnts_sort, cnt_is_card, image, executor, cnt_corners, suits, fast_warp)
+
+    matches = match_cards(cards, train_ranks, train_suits, backend, suits=suits)
+    for qCard, (rank_name, suit_name, rank_diff, suit_diff) in zip(cards, matches):
+        qCard.best_rank_match, qCard.best_suit_match = rank_name, suit_name
+        qCard.rank_diff, qCard.suit_diff = rank_diff, suit_diff
+
+    return cards
+
+
+def label_sprite(text, color=(50,200,200)):
+    """Returns the pre-rendered sprite of an overlay label, drawn the way
+    cv2.putText draws it in draw_results: in color, with a black outline.
+    A sprite is (premultiplied BGR image, inverse alpha, x, y), both as
+    uint8 images, where x, y is the position of the text origin inside the
+    sprite. Sprites are rendered once and cached."""
+
+    key = (text, color)
+    sprite = _LABEL_SPRITES.get(key)
+    if sprite is not None:
+        return sprite
+
+    (w, h), baseline = cv2.getTextSize(text, font, 1, 3)
+    pad = 3
+    x, y = pad, pad + h
+    size = (h + baseline + 2 * pad, w + 2 * pad)
+    img = np.zeros(size + (3,), np.uint8)
+    mask = np.zeros(size, np.uint8)
+
+    # Draw the text twice, so letters have black outline. On a black
+    # background the rendered colors are already premultiplied by alpha.
+    cv2.putText(img,text,(x,y),font,1,(0,0,0),3,cv2.LINE_AA)
+    cv2.putText(img,text,(x,y),font,1,color,2,cv2.LINE_AA)
+    cv2.putText(mask,text,(x,y),font,1,255,3,cv2.LINE_AA)
+    cv2.putText(mask,text,(x,y),font,1,255,2,cv2.LINE_AA)
+
+    inv_alpha = cv2.cvtColor(255 - mask, cv2.COLOR_GRAY2BGR)
+    sprite = (img, inv_alpha, x, y)
+    _LABEL_SPRITES[key] = sprite
+    return sprite
+
+def blend_sprite(image, sprite, x, y):
+    """Blends a sprite into image with its origin at x, y, clipped to the
+    image edges."""
+
+    img, inv_alpha, ox, oy = sprite
+    x0, y0 = x - ox, y - oy
+    x1, y1 = x0 + img.shape[1], y0 + img.shape[0]
+    cx0, cy0 = max(x0, 0), max(y0, 0)
+    cx1, cy1 = min(x1, image.shape[1]), min(y1, image.shape[0])
+    if cx0 >= cx1 or cy0 >= cy1:
+        return
+    roi = image[cy0:cy1, cx0:cx1]
+    img = img[cy0 - y0:cy1 - y0, cx0 - x0:cx1 - x0]
+    inv_alpha = inv_alpha[cy0 - y0:cy1 - y0, cx0 - x0:cx1 - x0]
+
+    # roi * (1 - alpha) + premultiplied sprite, in place
+    cv2.multiply(roi, inv_alpha, dst=roi, scale=1/255)
+    cv2.add(roi, img, dst=roi)
+
 def draw_results(image, qCard):
-    """Draw the card name, center point, and contour on the camera image."""
+    """Draw the card name, center point, and contour on the camera image.
+    The labels are blended in from cached sprites instead of being
+    rendered with cv2.putText again for every card."""
 
     x = qCard.center[0]
     y = qCard.center[1]
@@ -293,12 +672,9 @@ def draw_results(image, qCard):
     rank_name = qCard.best_rank_match
     suit_name = qCard.best_suit_match
 
-    # Draw card name twice, so letters have black outline
-    cv2.putText(image,(rank_name+' of'),(x-60,y-10),font,1,(0,0,0),3,cv2.LINE_AA)
-    cv2.putText(image,(rank_name+' of'),(x-60,y-10),font,1,(50,200,200),2,cv2.LINE_AA)
-
-    cv2.putText(image,suit_name,(x-60,y+25),font,1,(0,0,0),3,cv2.LINE_AA)
-    cv2.putText(image,suit_name,(x-60,y+25),font,1,(50,200,200),2,cv2.LINE_AA)
+    # Card name, with black outline
+    blend_sprite(image, label_sprite(rank_name+' of'), x-60, y-10)
+    blend_sprite(image, label_sprite(suit_name), x-60, y+25)
     
     # Can draw difference value for troubleshooting purposes
     # (commented out during normal operation)
@@ -309,10 +685,10 @@ def draw_results(image, qCard):
 
     return image
 
-def flattener(image, pts, w, h):
-    """Flattens an image of a card into a top-down 200x300 perspective.
-    Returns the flattened, re-sized, grayed image.
-    See www.pyimagesearch.com/2014/08/25/4-point-opencv-getperspective-transform-example/"""
+def order_corners(pts, w, h):
+    """Orders the four corner points of a card as [top left, top right,
+    bottom right, bottom left] of the upright card, using the width w and
+    height h of its bounding rectangle to tell how it is oriented."""
     temp_rect = np.zeros((4,2), dtype = "float32")
     
     s = np.sum(pts, axis = 2)
@@ -364,10 +740,17 @@ def flattener(image, pts, w, h):
             temp_rect[1] = pts[3][0] # Top right
             temp_rect[2] = pts[2][0] # Bottom right
             temp_rect[3] = pts[1][0] # Bottom left
-            
+
+    return temp_rect
+
+def flattener(image, pts, w, h):
+    """Flattens an image of a card into a top-down 200x300 perspective.
+    Returns the flattened, re-sized, grayed image.
+    See www.pyimagesearch.com/2014/08/25/4-point-opencv-getperspective-transform-example/"""
+    temp_rect = order_corners(pts, w, h)
         
-    maxWidth = 200
-    maxHeight = 300
+    maxWidth = FLAT_WIDTH
+    maxHeight = FLAT_HEIGHT
 
     # Create destination array, calculate perspective transform matrix,
     # and warp card image
@@ -379,3 +762,22 @@ def flattener(image, pts, w, h):
         
 
     return warp
+
+def corner_warp(gray, pts, w, h):
+    """Warps only the rank and suit corner of a card out of a grayed image,
+    straight into the CORNER_ZOOM times zoomed patch that flattener and a
+    resize would produce together. One warp of a 128x336 patch replaces the
+    200x300 color warp, its gray conversion and the resize. The patch is
+    interpolated once instead of twice, so it is not identical to the
+    flattened one, and a few borderline cards get a different rank or suit
+    (Benchmark.py --synthetic --parity counts them)."""
+    temp_rect = order_corners(pts, w, h)
+
+    # Same transform as flattener, followed by the zoom. cv2.resize maps
+    # pixel centers, so zoomed x' = CORNER_ZOOM * (x + 0.5) - 0.5.
+    dst = np.array([[0,0],[FLAT_WIDTH-1,0],[FLAT_WIDTH-1,FLAT_HEIGHT-1],[0,FLAT_HEIGHT-1]], np.float32)
+    M = cv2.getPerspectiveTransform(temp_rect,dst)
+    offset = (CORNER_ZOOM - 1) / 2
+    zoom = np.array([[CORNER_ZOOM,0,offset],[0,CORNER_ZOOM,offset],[0,0,1]])
+    size = (CORNER_WIDTH * CORNER_ZOOM, CORNER_HEIGHT * CORNER_ZOOM)
+    return cv2.warpPerspective(gray, zoom @ M, size)
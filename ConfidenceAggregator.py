@@ -0,0 +1,107 @@
+### Streaming aggregation of card detections during a scan ###
+#
+# A scan collects rank detections per table zone (dealer and player) frame
+# after frame. Instead of keeping every confidence, each (zone, rank) pair
+# keeps a few running numbers, and the scan can stop as soon as the ranks
+# seen in every zone have stopped changing, rather than after a fixed time.
+
+# Weight of the past in the decayed averages. Each new frame counts for
+# 1 - SCAN_DECAY of the average.
+SCAN_DECAY = 0.7
+
+# Detection frames the leading ranks of every zone must stay the same for
+# before a scan can end
+STABLE_FRAMES = 5
+
+# Decayed fraction of frames a rank must have been seen in to lead its zone
+LEAD_PRESENCE = 0.5
+
+# How far the weakest leading rank of a zone must be ahead of the strongest
+# other rank, in decayed presence, for the zone to count as stable
+LEAD_MARGIN = 0.3
+
+
+class Rank_stats:
+    """Structure to store the running statistics of one rank in one zone."""
+
+    def __init__(self):
+        self.count = 0 # Number of times the rank was detected
+        self.max = 0.0 # Highest confidence it was detected with
+        self.mean = 0.0 # Decayed mean of its confidences
+        self.presence = 0.0 # Decayed fraction of frames it was detected in
+        self.seen = False # Detected in the current frame
+
+
+class Confidence_aggregator:
+    """Aggregates (zone, rank, confidence) detections over the frames of a
+    scan in constant memory per (zone, rank). Call add() for every detection
+    of a frame, then end_frame(), which returns True once the leading ranks
+    of every zone have been stable for stable_frames freshly matched frames."""
+
+    def __init__(self, zones, stable_frames=STABLE_FRAMES, decay=SCAN_DECAY, margin=LEAD_MARGIN):
+        self.zones = list(zones)
+        self.stable_frames = stable_frames
+        self.decay = decay
+        self.margin = margin
+
+        self.stats = {zone: {} for zone in self.zones} # zone -> rank -> Rank_stats
+        self.leaders = {zone: frozenset() for zone in self.zones}
+        self.frames = 0
+        self.stable_count = 0
+
+    def add(self, zone, rank, confidence):
+        """Adds one detection of rank in zone to the current frame."""
+
+        stats = self.stats[zone].get(rank)
+        if stats is None:
+            stats = self.stats[zone][rank] = Rank_stats()
+        if stats.count == 0:
+            stats.mean = confidence
+        else:
+            stats.mean = self.decay * stats.mean + (1 - self.decay) * confidence
+        stats.count = stats.count + 1
+        stats.max = max(stats.max, confidence)
+        stats.seen = True
+
+    def end_frame(self, fresh=True):
+        """Closes the current frame. Returns True if every zone has leading
+        ranks that have been the same, and far enough ahead of the other
+        ranks, for stable_frames frames in a row. A frame whose detections
+        were replayed from an earlier one is passed with fresh=False; it
+        counts towards presence but not towards stable_frames, so one match
+        can't make a scan stable on its own."""
+
+        self.frames = self.frames + 1
+        stable = True
+        for zone in self.zones:
+            for stats in self.stats[zone].values():
+                stats.presence = self.decay * stats.presence + (1 - self.decay) * stats.seen
+                stats.seen = False
+
+            leaders = self.leading(zone)
+            if leaders != self.leaders[zone]:
+                self.leaders[zone] = leaders
+                stable = False
+            elif len(leaders) == 0 or self.lead(zone, leaders) < self.margin:
+                stable = False
+
+        if stable:
+            if fresh:
+                self.stable_count = self.stable_count + 1
+        else:
+            self.stable_count = 0
+        return self.stable_count >= self.stable_frames
+
+    def leading(self, zone):
+        """Returns the set of known ranks seen in most recent frames of zone."""
+
+        return frozenset(rank for rank, stats in self.stats[zone].items()
+                         if rank != "Unknown" and stats.presence >= LEAD_PRESENCE)
+
+    def lead(self, zone, leaders):
+        """Returns how far the weakest leading rank of zone is ahead of the
+        strongest other rank, in decayed presence."""
+
+        weakest = min(self.stats[zone][rank].presence for rank in leaders)
+        others = [stats.presence for rank, stats in self.stats[zone].items() if rank not in leaders]
+        return weakest - max(others, default=0.0)
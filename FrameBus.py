@@ -0,0 +1,335 @@
+### Multi-process card detection over a shared memory frame bus ###
+#
+# Frames are copied once into a fixed set of slots in shared memory and only
+# the slot number travels to the worker processes, so full frames are never
+# pickled. Each worker runs the Cards pipeline on its slot and sends back the
+# detected cards, which are handed out in the order the frames came in.
+
+import queue
+import threading
+import traceback
+import multiprocessing as mp
+from multiprocessing import connection
+from multiprocessing import shared_memory
+import numpy as np
+import cv2
+import Cards
+import TemplateBank
+
+# Seconds between checks that the worker processes are still alive
+WORKER_CHECK_INTERVAL = 0.5
+
+
+class Frame_bus:
+    """Fixed number of equally sized frame slots in shared memory. Created by
+    the capturing process and attached by name in the worker processes."""
+
+    def __init__(self, shape, num_slots, name=None, create=True):
+        self.shape = tuple(shape)
+        self.num_slots = num_slots
+        size = num_slots * int(np.prod(self.shape))
+
+        if create:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            # Workers are children of the creating process and share its
+            # resource tracker, so attaching registers nothing new
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.frames = np.ndarray((num_slots,) + self.shape, dtype=np.uint8, buffer=self.shm.buf)
+        self.name = self.shm.name
+        self.owner = create
+
+    def close(self):
+        """Releases this process' mapping, and frees the memory if this
+        process created it."""
+
+        self.frames = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def strip_card(qCard):
+    """Drops the images a Query_card holds, so only its identity and
+    geometry are sent back to the capturing process."""
+
+    qCard.warp = []
+    qCard.rank_img = []
+    qCard.suit_img = []
+    qCard.suit_region = []
+    return qCard
+
+
+def worker_main(bus_name, shape, num_slots, tasks, results, bank_path, backend, suits=True):
+    """Worker process loop. Receives (ticket, slot, seq, timestamp) tasks,
+    runs the pipeline on the frame in that slot and sends back (ticket, slot,
+    seq, timestamp, cards). tasks and results are this worker's own ends of
+    two pipes. Stops on a None task. If suits
+    is False, only ranks are matched. A frame the pipeline fails on gets None
+    instead of a list of cards."""
+
+    # Parallelism comes from the processes, one OpenCV thread each
+    cv2.setNumThreads(1)
+    bus = Frame_bus(shape, num_slots, name=bus_name, create=False)
+    # Every worker maps the same bank file, so the templates are in memory once
+    rank_bank, suit_bank = TemplateBank.load(bank_path)
+
+    while True:
+        task = tasks.recv()
+        if task is None:
+            break
+        ticket, slot, seq, timestamp = task
+        try:
+            cards = Cards.process_frame(bus.frames[slot], rank_bank, suit_bank, backend, suits=suits)
+            cards = [strip_card(card) for card in cards]
+        except Exception:
+            print("Detection worker failed on frame %s:" % seq)
+            traceback.print_exc()
+            cards = None
+        results.send((ticket, slot, seq, timestamp, cards))
+
+    bus.close()
+
+
+class Detection_pool:
+    """Pool of worker processes running the card detection pipeline on frames
+    published into a Frame_bus. Results come back from get() as (seq,
+    timestamp, cards) tuples in the order the frames were submitted. cards
+    is None for a frame that couldn't be detected, because the pipeline
+    failed on it or its worker died, so it isn't mistaken for an empty table.
+    context is the multiprocessing start method, None for the default."""
+
+    def __init__(self, shape, num_workers=2, num_slots=None, backend='absdiff', filepath=None, suits=True,
+                 context=None):
+        # Build the template bank here if needed, so workers only map it
+        bank_path = TemplateBank.ensure_bank(filepath)
+        if num_slots is None:
+            num_slots = 2 * num_workers
+
+        self.ctx = mp.get_context(context)
+        self.bus = Frame_bus(shape, num_slots)
+        self.bank_path = bank_path
+        self.backend = backend
+        self.suits = suits
+        # Every worker has a task pipe and a result pipe of its own, without
+        # locks, so a worker that dies at any point can't block the others.
+        # Results are written straight into the pipe, so nothing a worker
+        # reported is lost if it dies afterwards.
+        self.tasks = [None] * num_workers
+        self.results = [None] * num_workers
+        # Result pipes of replaced workers, as (reader, worker index, first
+        # ticket of the new worker), read until they run dry
+        self.retired = []
+        # Wake-ups and the None that stops the collector come through the
+        # control pipe
+        self.control_reader, self.control = self.ctx.Pipe(duplex=False)
+        # Held while a ticket is handed to a worker, while a dead worker is
+        # replaced and whenever inflight or retired is used, so every ticket
+        # is known to belong to one worker or the other
+        self.dispatch_lock = threading.Lock()
+        self.workers = [self.start_worker(i) for i in range(num_workers)]
+        self.inflight = {} # Ticket -> (slot, seq, timestamp, worker) of frames not answered yet
+        self.stopped = False
+        self.stopping = threading.Event()
+
+        # Slots not holding a frame that is waiting for or being processed
+        self.free_slots = queue.Queue()
+        for slot in range(num_slots):
+            self.free_slots.put(slot)
+
+        # Results are reordered by submission ticket before they are handed out
+        self.next_ticket = 0
+        self.pending = {}
+        self.output = queue.Queue()
+        self.collector = threading.Thread(target=self.collect, daemon=True)
+        self.collector.start()
+        self.watcher = threading.Thread(target=self.watch, daemon=True)
+        self.watcher.start()
+
+        self.feeder = None
+        self.feeding = threading.Event() # Cleared while the feeder is paused
+        self.feeding.set()
+
+    def start_worker(self, index):
+        """Starts worker process number index, with new pipes."""
+
+        task_reader, self.tasks[index] = self.ctx.Pipe(duplex=False)
+        self.results[index], result_writer = self.ctx.Pipe(duplex=False)
+        worker = self.ctx.Process(target=worker_main, daemon=True,
+                                  args=(self.bus.name, self.bus.shape, self.bus.num_slots, task_reader,
+                                        result_writer, self.bank_path, self.backend, self.suits))
+        worker.start()
+        # Only the worker holds these ends now, so its death closes the pipes
+        task_reader.close()
+        result_writer.close()
+        return worker
+
+    def submit(self, frame, seq=None, timestamp=None, timeout=None):
+        """Copies frame into a free slot and queues it for detection. Blocks
+        for at most timeout seconds while all slots are busy. Returns the
+        frame's ticket, or None if no slot became free in time."""
+
+        try:
+            slot = self.free_slots.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        return self.dispatch(slot, frame, seq, timestamp)
+
+    def dispatch(self, slot, frame, seq, timestamp):
+        """Copies frame into a slot taken from free_slots and queues it on
+        the worker with the fewest frames in flight."""
+
+        np.copyto(self.bus.frames[slot], frame)
+        with self.dispatch_lock:
+            ticket = self.next_ticket
+            self.next_ticket = self.next_ticket + 1
+            loads = [0] * len(self.workers)
+            for record in list(self.inflight.values()):
+                loads[record[3]] = loads[record[3]] + 1
+            index = loads.index(min(loads))
+            self.inflight[ticket] = (slot, seq, timestamp, index)
+            try:
+                self.tasks[index].send((ticket, slot, seq, timestamp))
+            except OSError:
+                pass # The worker died, the ticket is answered once it is replaced
+        return ticket
+
+    def collect(self):
+        """Collector thread. Frees the slot of every finished frame at once
+        and releases results to the output queue in ticket order. The pipe
+        of a replaced worker is read until it runs dry, and only then are
+        the frames that worker never answered given up on."""
+
+        self.next_out = 0
+        while True:
+            with self.dispatch_lock:
+                drained = [entry for entry in self.retired if entry[0].closed]
+                self.retired = [entry for entry in self.retired if not entry[0].closed]
+                readers = [reader for reader in self.results + [entry[0] for entry in self.retired]
+                           if not reader.closed]
+            for reader, index, restarted in drained:
+                self.give_up(index, restarted)
+
+            for reader in connection.wait(readers + [self.control_reader]):
+                if reader is self.control_reader:
+                    if reader.recv() is None:
+                        return
+                    continue # Woken up to wait on changed pipes
+                try:
+                    result = reader.recv()
+                except (EOFError, OSError):
+                    # The worker died and everything it sent has been read
+                    reader.close()
+                    continue
+                self.finish(*result)
+
+    def give_up(self, index, restarted):
+        """Answers the frames that replaced worker number index was given
+        before ticket restarted, and never answered, as failed (None cards)."""
+
+        with self.dispatch_lock:
+            lost = [(ticket, record) for ticket, record in self.inflight.items()
+                    if record[3] == index and ticket < restarted]
+        for ticket, (slot, seq, timestamp, index) in sorted(lost):
+            self.finish(ticket, slot, seq, timestamp, None)
+
+    def finish(self, ticket, slot, seq, timestamp, cards):
+        """Frees the slot of an answered ticket and releases every result
+        that is next in ticket order. Tickets already answered are ignored."""
+
+        with self.dispatch_lock:
+            if self.inflight.pop(ticket, None) is None:
+                return
+        self.free_slots.put(slot)
+        self.pending[ticket] = (seq, timestamp, cards)
+        while self.next_out in self.pending:
+            self.output.put(self.pending.pop(self.next_out))
+            self.next_out = self.next_out + 1
+
+    def watch(self):
+        """Watcher thread. Replaces worker processes that died. The collector
+        reads what a dead worker sent before it died, and answers the rest
+        of its frames as failed, so later results aren't held back."""
+
+        while not self.stopping.wait(WORKER_CHECK_INTERVAL):
+            for index, worker in enumerate(self.workers):
+                if worker.is_alive() or self.stopping.is_set():
+                    continue
+                print("Detection worker %d exited with code %s, restarting it" % (index, worker.exitcode))
+                # Tickets from restarted on go to the new worker. Only earlier
+                # ones were sent to the dead worker, so only their slots can
+                # be freed without a result.
+                with self.dispatch_lock:
+                    restarted = self.next_ticket
+                    self.retired.append((self.results[index], index, restarted))
+                    self.workers[index] = self.start_worker(index)
+                # Wakes the collector, to wait on the new worker's pipe
+                self.control.send(-1)
+
+    def get(self, timeout=None):
+        """Returns the next (seq, timestamp, cards) result in submission
+        order, or None if none arrives within timeout seconds. cards is None
+        if the frame couldn't be detected."""
+
+        try:
+            return self.output.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def feed(self, videostream):
+        """Starts a thread that publishes every new frame of a VideoStream
+        into the bus, tagged with its sequence number and timestamp. When all
+        slots are busy it waits, then publishes the newest frame. Frames that
+        arrive while the feeder is paused are skipped."""
+
+        def run():
+            last_seq = 0
+            while not self.stopped:
+                if not self.feeding.wait(0.1):
+                    continue
+                new_frame = videostream.read_new(last_seq, timeout=0.1, copy=False)
+                if new_frame is None:
+                    if videostream.finished:
+                        break
+                    continue
+                try:
+                    slot = self.free_slots.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                # Frames may have arrived while waiting, publish the newest
+                last_seq, timestamp, frame = videostream.read_stamped(copy=False)
+                self.dispatch(slot, frame, last_seq, timestamp)
+
+        self.feeder = threading.Thread(target=run, daemon=True)
+        self.feeder.start()
+        return self
+
+    def pause(self):
+        """Stops the feeder from publishing frames until resume() is called.
+        Frames already published are still processed."""
+
+        self.feeding.clear()
+
+    def resume(self):
+        """Lets a paused feeder publish frames again."""
+
+        self.feeding.set()
+
+    def close(self):
+        """Stops the feeder and the workers and frees the shared memory."""
+
+        self.stopped = True
+        self.stopping.set()
+        self.watcher.join()
+        if self.feeder is not None:
+            self.feeder.join()
+        for tasks in self.tasks:
+            try:
+                tasks.send(None)
+            except OSError:
+                pass
+        for worker in self.workers:
+            worker.join()
+        self.control.send(None)
+        self.collector.join()
+        self.bus.close()
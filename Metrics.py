@@ -0,0 +1,334 @@
+### Lightweight metrics for the card detection pipeline ###
+#
+# Keeps rolling histograms of stage latencies, cards per frame and other
+# values, plus counters and gauges, and periodically rewrites them to a
+# JSON or Prometheus text file so slowdowns show up on a dashboard before
+# anyone at the table notices them. Recording a value costs a dictionary
+# lookup, a bisect and an increment under a lock.
+
+import os
+import json
+import time
+import bisect
+import functools
+import threading
+from contextlib import contextmanager
+
+# Histogram bucket upper bounds. Latencies use doubling buckets from 50 us
+# to about 50 s, counts (e.g. cards per frame) use one bucket per value.
+SECONDS_BOUNDS = [0.00005 * 2 ** i for i in range(21)]
+COUNT_BOUNDS = list(range(21))
+
+# Rolling window of the histograms: WINDOWS sub-windows of WINDOW_SECONDS
+# each. Percentiles cover the last WINDOWS * WINDOW_SECONDS seconds.
+WINDOW_SECONDS = 10
+WINDOWS = 6
+
+PERCENTILES = [50, 95, 99]
+
+# Prefix of the metric names in the Prometheus export
+PROMETHEUS_PREFIX = 'card_detector_'
+
+# Seconds between rewrites of the metrics file
+EXPORT_INTERVAL = 5.0
+
+# Cards pipeline functions timed by instrument_cards
+CARD_STAGES = ['preprocess_image', 'find_cards', 'preprocess_cards', 'match_cards', 'match_suit',
+               'draw_results']
+
+
+class Histogram:
+    """Histogram over fixed buckets, kept both in total (for Prometheus) and
+    over a rolling window of recent sub-windows (for percentiles)."""
+
+    def __init__(self, bounds, window_seconds=WINDOW_SECONDS, windows=WINDOWS):
+        self.bounds = list(bounds)
+        self.window_seconds = window_seconds
+        self.totals = [0] * (len(self.bounds) + 1) # The last bucket is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.windows = [[0] * (len(self.bounds) + 1) for i in range(windows)]
+        self.current = 0
+        self.window_start = time.monotonic()
+
+    def rotate(self, now):
+        """Moves on to a fresh sub-window if the current one is over."""
+
+        while now - self.window_start >= self.window_seconds:
+            self.current = (self.current + 1) % len(self.windows)
+            self.windows[self.current] = [0] * (len(self.bounds) + 1)
+            self.window_start = self.window_start + self.window_seconds
+            if now - self.window_start >= self.window_seconds * len(self.windows):
+                # Idle for longer than the whole window, start over
+                for window in self.windows:
+                    window[:] = [0] * len(window)
+                self.window_start = now
+
+    def observe(self, value, now):
+        """Counts value, observed at time.monotonic() time now."""
+
+        bucket = bisect.bisect_left(self.bounds, value)
+        self.rotate(now)
+        self.windows[self.current][bucket] = self.windows[self.current][bucket] + 1
+        self.totals[bucket] = self.totals[bucket] + 1
+        self.sum = self.sum + value
+        self.count = self.count + 1
+
+    def recent(self, now):
+        """Returns the bucket counts of the rolling window."""
+
+        self.rotate(now)
+        return [sum(counts) for counts in zip(*self.windows)]
+
+    def percentile(self, counts, p):
+        """Returns the upper bound of the bucket holding the p-th percentile
+        of counts, or None if counts is empty."""
+
+        total = sum(counts)
+        if total == 0:
+            return None
+        rank = total * p / 100
+        seen = 0
+        for bucket, count in enumerate(counts):
+            seen = seen + count
+            if seen >= rank and count:
+                return self.bounds[bucket] if bucket < len(self.bounds) else float('inf')
+        return float('inf')
+
+
+class Registry:
+    """Thread-safe collection of histograms, counters and gauges, each
+    identified by a name and optional labels."""
+
+    def __init__(self, window_seconds=WINDOW_SECONDS, windows=WINDOWS):
+        self.window_seconds = window_seconds
+        self.windows = windows
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.collectors = [] # Functions called before every export
+
+    def observe(self, name, value, bounds=SECONDS_BOUNDS, **labels):
+        """Records value in the histogram name. The buckets are fixed by the
+        first observation."""
+
+        key = (name, tuple(sorted(labels.items())))
+        now = time.monotonic()
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(bounds, self.window_seconds, self.windows)
+            histogram.observe(value, now)
+
+    def count(self, name, n=1, **labels):
+        """Adds n to the counter name."""
+
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def set_gauge(self, name, value, **labels):
+        """Sets the gauge name to value."""
+
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Context manager that records how long its block took, in
+        seconds, in the histogram name."""
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def add_collector(self, collector):
+        """Registers a function that is called with the registry before
+        every snapshot, to update gauges from elsewhere."""
+
+        self.collectors.append(collector)
+
+    def snapshot(self):
+        """Returns all metrics as a dictionary that can be dumped as JSON.
+        Histograms report their rolling count and percentiles next to their
+        totals. A percentile in the overflow bucket is reported as the
+        string '+Inf', as strict JSON has no infinity."""
+
+        for collector in self.collectors:
+            collector(self)
+
+        now = time.monotonic()
+        report = {'time': time.time(), 'window_seconds': self.window_seconds * self.windows,
+                  'histograms': [], 'counters': [], 'gauges': []}
+        with self.lock:
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                counts = histogram.recent(now)
+                entry = {'name': name, 'labels': dict(labels), 'count': histogram.count,
+                         'sum': histogram.sum, 'recent_count': sum(counts)}
+                for p in PERCENTILES:
+                    value = histogram.percentile(counts, p)
+                    entry['p%d' % p] = '+Inf' if value == float('inf') else value
+                report['histograms'].append(entry)
+            for (name, labels), value in sorted(self.counters.items()):
+                report['counters'].append({'name': name, 'labels': dict(labels), 'value': value})
+            for (name, labels), value in sorted(self.gauges.items()):
+                report['gauges'].append({'name': name, 'labels': dict(labels), 'value': value})
+        return report
+
+    def to_json(self):
+        """Returns the snapshot as JSON text."""
+
+        return json.dumps(self.snapshot(), indent=2, allow_nan=False)
+
+    def to_prometheus(self):
+        """Returns all metrics in the Prometheus text exposition format.
+        Histograms are exported with their total (not rolling) buckets."""
+
+        for collector in self.collectors:
+            collector(self)
+
+        lines = []
+        typed = set()
+        with self.lock:
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                metric = PROMETHEUS_PREFIX + name
+                if metric not in typed:
+                    lines.append('# TYPE %s histogram' % metric)
+                    typed.add(metric)
+                seen = 0
+                for bound, count in zip(histogram.bounds + ['+Inf'], histogram.totals):
+                    seen = seen + count
+                    le = bound if bound == '+Inf' else '%g' % bound
+                    lines.append('%s_bucket%s %d' % (metric, format_labels(labels + (('le', le),)), seen))
+                lines.append('%s_sum%s %r' % (metric, format_labels(labels), histogram.sum))
+                lines.append('%s_count%s %d' % (metric, format_labels(labels), histogram.count))
+            for kind, values in [('counter', self.counters), ('gauge', self.gauges)]:
+                for (name, labels), value in sorted(values.items()):
+                    metric = PROMETHEUS_PREFIX + name
+                    if metric not in typed:
+                        lines.append('# TYPE %s %s' % (metric, kind))
+                        typed.add(metric)
+                    lines.append('%s%s %r' % (metric, format_labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    """Formats ((key, value), ...) label pairs as a Prometheus label set."""
+
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % (key, value) for key, value in labels) + '}'
+
+
+# Registry the module level helpers and the instrumentation report to
+REGISTRY = Registry()
+
+
+def observe(name, value, bounds=SECONDS_BOUNDS, **labels):
+    REGISTRY.observe(name, value, bounds, **labels)
+
+
+def count(name, n=1, **labels):
+    REGISTRY.count(name, n, **labels)
+
+
+def timer(name, **labels):
+    return REGISTRY.timer(name, **labels)
+
+
+def instrument(module, names, metric='stage_seconds', registry=None):
+    """Replaces the functions names of module by wrappers that record their
+    run time in the histogram metric, labelled with the function name.
+    Functions already wrapped are left alone."""
+
+    if registry is None:
+        registry = REGISTRY
+    for name in names:
+        function = getattr(module, name)
+        if getattr(function, 'instrumented', False):
+            continue
+
+        def wrapper(*args, _function=function, _name=name, **kwargs):
+            start = time.perf_counter()
+            try:
+                return _function(*args, **kwargs)
+            finally:
+                registry.observe(metric, time.perf_counter() - start, stage=_name)
+
+        wrapper = functools.wraps(function)(wrapper)
+        wrapper.instrumented = True
+        setattr(module, name, wrapper)
+
+
+def instrument_cards(registry=None):
+    """Times the stages of the Cards pipeline. Functions inside Cards that
+    call each other (e.g. process_frame) go through the wrappers too."""
+
+    import Cards
+    instrument(Cards, CARD_STAGES, registry=registry)
+
+
+def instrument_stream(videostream, registry=None):
+    """Makes a VideoStream report its capture intervals and decode times,
+    and exports its frame and dropped frame counts as gauges."""
+
+    if registry is None:
+        registry = REGISTRY
+    videostream.metrics = registry
+
+    def collect(registry):
+        registry.set_gauge('frames_captured', videostream.seq)
+        registry.set_gauge('frames_dropped', videostream.dropped_frames)
+
+    registry.add_collector(collect)
+
+
+class Exporter:
+    """Thread that rewrites a metrics file every interval seconds. Files
+    ending in .prom get the Prometheus text format, others JSON. The file
+    is replaced atomically, so readers never see a partial write."""
+
+    def __init__(self, path, interval=EXPORT_INTERVAL, registry=None, fmt=None):
+        self.path = path
+        self.interval = interval
+        self.registry = REGISTRY if registry is None else registry
+        self.fmt = fmt if fmt is not None else ('prometheus' if path.endswith('.prom') else 'json')
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """Starts the export thread."""
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def run(self):
+        """Export thread loop."""
+
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def write(self):
+        """Writes the current metrics to the file."""
+
+        if self.fmt == 'prometheus':
+            text = self.registry.to_prometheus()
+        else:
+            text = self.registry.to_json()
+        temp = self.path + '.tmp'
+        with open(temp, 'w') as f:
+            f.write(text)
+        os.replace(temp, self.path)
+
+    def stop(self):
+        """Stops the thread and writes the file one last time."""
+
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.write()
@@ -0,0 +1,144 @@
+### Motion gating for the card detection loops ###
+#
+# Compares a heavily downscaled gray version of every frame with the one
+# before it. Frames that show nothing new, and frames taken while a hand is
+# still moving over the table, don't need the Cards pipeline; detection runs
+# once the picture has settled again, and the gate reports where it changed.
+
+import numpy as np
+import cv2
+
+# Downscale factor of the frames the gate compares
+MOTION_SCALE = 8
+
+# Gray level difference of a downscaled pixel that counts as a change
+MOTION_THRESH = 20
+
+# Fraction of changed downscaled pixels above which the frame counts as
+# moving, so sensor noise and single specks are ignored
+MOTION_FRACTION = 0.002
+
+# Still frames needed after motion before detection runs again, so the
+# frames of a moving hand or a card being slid in are never matched
+SETTLE_FRAMES = 3
+
+# Gate states
+STILL = 'still' # Nothing changed since the last detection
+MOVING = 'moving' # Something is moving, or hasn't been still long enough
+SETTLED = 'settled' # The picture changed and is now steady, detect again
+
+
+def shrink_gray(image, scale):
+    """Returns a gray copy of image shrunk by scale. Bilinear shrinking only
+    reads a few pixels per output pixel, so this is much cheaper than
+    converting the full frame."""
+
+    img_h, img_w = image.shape[:2]
+    small = cv2.resize(image, (max(img_w // scale, 1), max(img_h // scale, 1)), interpolation=cv2.INTER_LINEAR)
+    return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+
+
+def mask_regions(mask, scale, margin, img_w, img_h):
+    """Turns a downscaled change mask into (x, y, w, h) rectangles in full
+    resolution around each changed blob, grown by margin pixels and merged
+    where they overlap."""
+
+    cnts, hier = cv2.findContours(np.uint8(mask) * 255, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    rects = []
+    for cnt in cnts:
+        x, y, w, h = cv2.boundingRect(cnt)
+        rects.append([max(x * scale - margin, 0), max(y * scale - margin, 0),
+                      min((x + w) * scale + margin, img_w), min((y + h) * scale + margin, img_h)])
+    rects = merge_rects(rects)
+    return [(x1, y1, x2 - x1, y2 - y1) for x1, y1, x2, y2 in rects]
+
+
+def merge_rects(rects):
+    """Merges overlapping [x1, y1, x2, y2] rectangles until none overlap."""
+
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(rects)):
+            for j in range(i + 1, len(rects)):
+                a, b = rects[i], rects[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    rects[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                    del rects[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return rects
+
+
+class Motion_gate:
+    """Decides, frame by frame, whether the card detection pipeline needs to
+    run. update() returns True on the first frame and whenever the picture
+    has settled after a change; self.regions then holds the (x, y, w, h)
+    rectangles that changed."""
+
+    def __init__(self, scale=MOTION_SCALE, thresh=MOTION_THRESH, min_fraction=MOTION_FRACTION,
+                 settle_frames=SETTLE_FRAMES, margin=0):
+        self.scale = scale
+        self.thresh = thresh
+        self.min_fraction = min_fraction
+        self.settle_frames = settle_frames
+        self.margin = margin # Pixels added around reported regions
+
+        self.previous = None # Downscaled gray version of the previous frame
+        self.motion_mask = None # Everything that changed since the last detection
+        self.still_count = 0
+        self.state = STILL
+        self.regions = []
+
+        # Counters for how many frames the gate let through
+        self.frames = 0
+        self.detect_frames = 0
+
+    def update(self, image):
+        """Feeds one camera image to the gate. Returns True if the card
+        detection pipeline should run on it."""
+
+        self.frames = self.frames + 1
+        img_h, img_w = image.shape[:2]
+        small = shrink_gray(image, self.scale)
+
+        if self.previous is None or self.previous.shape != small.shape:
+            self.previous = small
+            return self.settle([(0, 0, img_w, img_h)])
+
+        changed = cv2.absdiff(small, self.previous) > self.thresh
+        self.previous = small
+
+        if changed.mean() > self.min_fraction:
+            if self.motion_mask is None:
+                self.motion_mask = changed
+            else:
+                self.motion_mask = self.motion_mask | changed
+            self.still_count = 0
+            self.state = MOVING
+            return False
+
+        if self.motion_mask is None:
+            self.state = STILL
+            return False
+
+        # Wait until the picture has been still for a few frames
+        self.still_count = self.still_count + 1
+        if self.still_count < self.settle_frames:
+            self.state = MOVING
+            return False
+
+        regions = mask_regions(self.motion_mask, self.scale, self.margin, img_w, img_h)
+        return self.settle(regions)
+
+    def settle(self, regions):
+        """Marks the picture as settled with the given changed regions."""
+
+        self.motion_mask = None
+        self.still_count = 0
+        self.state = SETTLED
+        self.regions = regions
+        self.detect_frames = self.detect_frames + 1
+        return True
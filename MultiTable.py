@@ -0,0 +1,351 @@
+### Several tables in one process ###
+#
+# Drives N camera streams (or video files standing in for them) through one
+# shared template bank and one bounded pool of detection worker processes.
+# Every table keeps its own state: zones, scan aggregator and HiLo running
+# count. The scheduler hands free pool slots to the tables round robin, and
+# no table may have more than its share of slots in flight, so a busy table
+# can't starve the others. Each table's throughput and its capture-to-result
+# latency are reported.
+#
+# With --tables, the given sources are replayed as 1, 2, 4, ... tables to
+# find how many tables the machine sustains at the source frame rate.
+#
+# Usage: python MultiTable.py <camera index or video file> ... [options]
+#        python MultiTable.py table.avi --tables 1,2,4,8 --workers 4
+
+import argparse
+import collections
+import json
+import os
+import time
+import numpy as np
+import Cards
+import VideoStream
+import FrameBus
+import ConfidenceAggregator
+import Assistant
+import Metrics
+
+# Frame rate asked of the cameras, and at which video files are replayed
+TABLE_FRAME_RATE = 10
+
+# Camera resolution. All tables share the pool's frame slots, so every
+# source must deliver frames of the same size.
+IM_WIDTH = 1280
+IM_HEIGHT = 720
+
+# Fraction of the frame height, from the top, that is the dealer's zone
+DEALER_FRACTION = 0.5
+
+# Frames in a row without any card after which the table counts as cleared,
+# and the next cards seen belong to a new hand
+CLEAR_FRAMES = 5
+
+# Latencies kept per table for the report
+LATENCY_SAMPLES = 10000
+
+# Fraction of its source frame rate a table must be processed at to count
+# as sustained
+SUSTAIN_FRACTION = 0.9
+
+PERCENTILES = [50, 95, 99]
+
+# Start method of the detection workers. The streams' capture threads are
+# running when workers are started or restarted, and a forked child could
+# inherit a lock one of them held, so workers come from a fork server.
+WORKER_CONTEXT = 'forkserver'
+
+
+class Table:
+    """State of one table: its stream, dealer/player zones, the aggregator
+    of the current hand, the running count and throughput counters."""
+
+    def __init__(self, name, videostream, dealer_fraction=DEALER_FRACTION,
+                 stable_frames=ConfidenceAggregator.STABLE_FRAMES, clear_frames=CLEAR_FRAMES):
+        self.name = name
+        self.videostream = videostream
+        self.dealer_fraction = dealer_fraction
+        self.stable_frames = stable_frames
+        self.clear_frames = clear_frames
+        self.running_count = 0
+        self.hands = 0 # Hands with at least one card counted
+        self.new_hand()
+
+        self.last_seq = 0 # Newest frame taken from the stream
+        self.first_seq = None # First frame taken, for the source frame rate
+        self.inflight = 0 # Frames submitted and not yet returned
+        self.submitted = 0
+        self.completed = 0
+        self.skipped = 0 # Frames the stream captured that were never submitted
+        self.cards = 0 # Cards detected in all completed frames
+        self.failed = 0 # Completed frames the pool couldn't detect
+        self.latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+
+    def zone(self, card, height):
+        """Returns the zone a detected card lies in."""
+
+        return 'dealer' if card.center[1] < height * self.dealer_fraction else 'player'
+
+    def new_hand(self):
+        """Starts a new hand: forgets what was seen and counted."""
+
+        self.aggregator = ConfidenceAggregator.Confidence_aggregator(['dealer', 'player'], self.stable_frames)
+        self.recent = collections.deque(maxlen=self.stable_frames) # Rank Counter of the last frames
+        self.counted = collections.Counter() # Rank -> copies of it counted in this hand
+        self.empty_frames = 0
+
+    def hand_cards(self):
+        """Returns a Counter of the ranks in the stable hand. A leading rank
+        appears as many times as it was most often detected in one of the
+        last frames, so a pair counts as two cards."""
+
+        hand = collections.Counter()
+        for zone in ['player', 'dealer']:
+            for rank in self.aggregator.leaders[zone]:
+                copies = collections.Counter(frame[(zone, rank)] for frame in self.recent).most_common(1)[0][0]
+                hand[rank] = hand[rank] + max(copies, 1)
+        return hand
+
+    def update(self, cards, height):
+        """Adds the cards detected in one frame. Once the hand is stable,
+        the cards in it that weren't counted yet are added to the running
+        count, so a card dealt into a counted hand counts only by itself.
+        A table without cards for clear_frames frames starts a new hand.
+        Frames the pool couldn't detect (cards is None) are ignored."""
+
+        if cards is None:
+            return
+        if len(cards) == 0:
+            self.empty_frames = self.empty_frames + 1
+            if self.empty_frames >= self.clear_frames and len(self.counted) != 0:
+                self.new_hand()
+            return
+        self.empty_frames = 0
+
+        frame = collections.Counter()
+        for card in cards:
+            zone = self.zone(card, height)
+            self.aggregator.add(zone, card.best_rank_match, 1.0 / (card.rank_diff + 1))
+            frame[(zone, card.best_rank_match)] = frame[(zone, card.best_rank_match)] + 1
+        self.recent.append(frame)
+        if not self.aggregator.end_frame():
+            return
+
+        new_cards = self.hand_cards() - self.counted
+        if len(new_cards) == 0:
+            return
+        if len(self.counted) == 0:
+            self.hands = self.hands + 1
+        for rank, copies in new_cards.items():
+            value = Assistant.calculate_card_value(Assistant.RANK_SYMBOLS.get(rank, rank))
+            self.running_count = self.running_count + value * copies
+        # Cards that drop out of view for a moment aren't counted again
+        self.counted = self.counted | self.hand_cards()
+
+    def report(self, elapsed):
+        """Returns the table's throughput and latency figures."""
+
+        captured = self.last_seq - self.first_seq + 1 if self.first_seq is not None else 0
+        report = {
+            'table': self.name,
+            'captured': captured,
+            'completed': self.completed,
+            'failed': self.failed,
+            'skipped': self.skipped,
+            'source_fps': captured / elapsed if elapsed > 0 else 0.0,
+            'frames_per_sec': self.completed / elapsed if elapsed > 0 else 0.0,
+            'cards_per_frame': self.cards / (self.completed - self.failed) if self.completed > self.failed else 0.0,
+            'hands': self.hands,
+            'running_count': self.running_count,
+        }
+        report['sustained'] = report['frames_per_sec'] >= SUSTAIN_FRACTION * report['source_fps']
+        if len(self.latencies) != 0:
+            samples = np.array(self.latencies) * 1000
+            for p, value in zip(PERCENTILES, np.percentile(samples, PERCENTILES)):
+                report['latency_p%d_ms' % p] = float(value)
+        return report
+
+
+class Table_runner:
+    """Runs several tables through one shared Detection_pool. The pool maps
+    the template bank once for all tables."""
+
+    def __init__(self, tables, num_workers=2, num_slots=None, backend='absdiff', suits=False):
+        self.tables = list(tables)
+        shapes = set(table.videostream.read(copy=False).shape for table in self.tables)
+        if len(shapes) != 1:
+            raise ValueError("All tables must deliver frames of the same size, got %s" % sorted(shapes))
+        self.shape = shapes.pop()
+
+        self.pool = FrameBus.Detection_pool(self.shape, num_workers, num_slots, backend, suits=suits,
+                                            context=WORKER_CONTEXT)
+        # Each table may have at most its share of the slots in flight
+        self.max_inflight = max(self.pool.bus.num_slots // len(self.tables), 1)
+        self.order = collections.deque() # Table of every frame in flight, in submission order
+        self.next_table = 0 # Where the next round robin pass starts
+
+    def schedule(self):
+        """Hands free slots to tables with a new frame, round robin. Returns
+        the number of frames submitted."""
+
+        submitted = 0
+        for i in range(len(self.tables)):
+            if self.pool.free_slots.empty():
+                break
+            index = (self.next_table + i) % len(self.tables)
+            table = self.tables[index]
+            if table.inflight >= self.max_inflight:
+                continue
+            new_frame = table.videostream.read_new(table.last_seq, timeout=0, copy=False)
+            if new_frame is None:
+                continue
+
+            seq, timestamp, frame = new_frame
+            if table.first_seq is None:
+                table.first_seq = seq
+            else:
+                table.skipped = table.skipped + seq - table.last_seq - 1
+            table.last_seq = seq
+            self.pool.dispatch(self.pool.free_slots.get_nowait(), frame, seq, timestamp)
+            self.order.append(table)
+            table.inflight = table.inflight + 1
+            table.submitted = table.submitted + 1
+            submitted = submitted + 1
+            # The next pass starts after the table served last
+            self.next_table = index + 1
+        return submitted
+
+    def collect(self, timeout):
+        """Handles finished frames, waiting up to timeout seconds for the
+        first one. Returns the number handled."""
+
+        handled = 0
+        result = self.pool.get(timeout=timeout)
+        while result is not None:
+            seq, timestamp, cards = result
+            # Results come back in submission order
+            table = self.order.popleft()
+            table.inflight = table.inflight - 1
+            table.completed = table.completed + 1
+            if cards is None:
+                table.failed = table.failed + 1
+            else:
+                table.cards = table.cards + len(cards)
+            latency = time.monotonic() - timestamp
+            table.latencies.append(latency)
+            Metrics.observe('table_latency_seconds', latency, table=table.name)
+            table.update(cards, self.shape[0])
+            handled = handled + 1
+            result = self.pool.get(timeout=0)
+        return handled
+
+    def run(self, seconds):
+        """Runs the tables for seconds seconds, or until every stream has
+        ended. Returns the elapsed time."""
+
+        start = time.monotonic()
+        while time.monotonic() - start < seconds:
+            if self.schedule() == 0 and len(self.order) == 0:
+                if all(table.videostream.finished for table in self.tables):
+                    break
+                time.sleep(0.002) # Nothing in flight, wait for new frames
+            self.collect(0.002 if len(self.order) else 0)
+
+        # Let the frames in flight finish, so counts are complete
+        while len(self.order):
+            self.collect(0.1)
+        return time.monotonic() - start
+
+    def report(self, elapsed):
+        """Returns the per-table reports and their totals."""
+
+        tables = [table.report(elapsed) for table in self.tables]
+        return {
+            'tables': tables,
+            'seconds': elapsed,
+            'frames_per_sec': sum(t['frames_per_sec'] for t in tables),
+            'sustained': all(t['sustained'] for t in tables),
+        }
+
+    def close(self):
+        for table in self.tables:
+            table.videostream.stop()
+        self.pool.close()
+
+
+def open_source(source, framerate=TABLE_FRAME_RATE):
+    """Opens a camera index, or a video file or image directory that is
+    replayed in a loop at framerate."""
+
+    if source.isdigit():
+        return VideoStream.VideoStream((IM_WIDTH, IM_HEIGHT), framerate, 2, int(source), low_latency=True).start()
+    return VideoStream.FileVideoStream(source, framerate, loop=True).start()
+
+
+def run_tables(sources, seconds, num_workers, framerate=TABLE_FRAME_RATE, backend='absdiff', suits=False):
+    """Runs one table per source for seconds seconds and returns the report."""
+
+    tables = [Table('table%d' % i, open_source(source, framerate)) for i, source in enumerate(sources)]
+    runner = Table_runner(tables, num_workers, backend=backend, suits=suits)
+    try:
+        elapsed = runner.run(seconds)
+    finally:
+        runner.close()
+    return runner.report(elapsed)
+
+
+def print_report(report):
+    """Prints the per-table results of a run."""
+
+    print("%-8s %8s %8s %8s %7s %9s" % ('table', 'src fps', 'fps', 'skipped', 'cards', 'hands')
+          + ''.join(' %7s' % ('p%d ms' % p) for p in PERCENTILES))
+    for t in report['tables']:
+        print("%-8s %8.1f %8.1f %8d %7.1f %9d" % (t['table'], t['source_fps'], t['frames_per_sec'],
+                                                  t['skipped'], t['cards_per_frame'], t['hands'])
+              + ''.join(' %7.1f' % t.get('latency_p%d_ms' % p, float('nan')) for p in PERCENTILES)
+              + ('' if t['sustained'] else '  behind'))
+    print("Total: %.1f frames/s over %.1f s, %s" % (report['frames_per_sec'], report['seconds'],
+                                                   'all tables sustained' if report['sustained'] else 'not sustained'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run card detection for several tables in one process.")
+    parser.add_argument('sources', nargs='+', help="camera indexes or video files, one per table")
+    parser.add_argument('--tables', default=None, help="replay the sources as each of these numbers of tables, e.g. 1,2,4,8")
+    parser.add_argument('--seconds', type=float, default=20.0, help="length of each run")
+    parser.add_argument('--workers', type=int, default=4, help="detection worker processes shared by all tables")
+    parser.add_argument('--fps', type=float, default=TABLE_FRAME_RATE, help="camera frame rate, and replay rate of files")
+    parser.add_argument('--backend', default='absdiff', choices=Cards.MATCH_BACKENDS, help="template matching backend")
+    parser.add_argument('--suits', action='store_true', help="match suits too, not only ranks")
+    parser.add_argument('--json', default=None, help="also write the reports to this JSON file")
+    parser.add_argument('--metrics', default=os.environ.get('CARD_METRICS_FILE'), help="rewrite table metrics to this file (.prom for Prometheus)")
+    args = parser.parse_args()
+
+    exporter = Metrics.Exporter(args.metrics).start() if args.metrics else None
+    reports = []
+    if args.tables is None:
+        report = run_tables(args.sources, args.seconds, args.workers, args.fps, args.backend, args.suits)
+        print_report(report)
+        reports.append(report)
+    else:
+        sustained = 0
+        for num_tables in [int(n) for n in args.tables.split(',')]:
+            sources = [args.sources[i % len(args.sources)] for i in range(num_tables)]
+            print("\n%d tables, %d workers:" % (num_tables, args.workers))
+            report = run_tables(sources, args.seconds, args.workers, args.fps, args.backend, args.suits)
+            print_report(report)
+            reports.append(report)
+            if report['sustained']:
+                sustained = max(sustained, num_tables)
+        print("\nSustained up to %d tables at %g fps with %d workers" % (sustained, args.fps, args.workers))
+
+    if exporter is not None:
+        exporter.stop()
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(reports, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
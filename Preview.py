@@ -0,0 +1,115 @@
+### Preview window and key input, or their headless replacements ###
+#
+# The detection loops used to show every frame at full size and poll the
+# keyboard through cv2.waitKey, which needs a display and costs time on
+# every frame. Preview shows only every Nth frame, optionally shrunk, and
+# in headless mode makes no GUI calls at all. Key commands then come from
+# lines typed on stdin or from signals instead.
+
+import os
+import sys
+import queue
+import signal
+import threading
+import cv2
+
+# Signals that stand in for key presses in headless mode. SIGUSR1 is not
+# available on Windows, so it is only used where it exists.
+SIGNAL_KEYS = {'SIGUSR1': 's'}
+
+# Signals that make a headless run quit
+QUIT_SIGNALS = ['SIGTERM', 'SIGINT']
+
+
+class Preview:
+    """Shows frames in a window and returns the keys pressed in it. Only
+    every Nth frame (every) is rendered, scaled by scale. If headless is
+    True, nothing is shown and keys are read from stdin lines and from the
+    signals in SIGNAL_KEYS. The signals in QUIT_SIGNALS set quit instead of
+    sending a key, so no loop can consume them. The end of stdin only stops
+    reading it, so runs with stdin closed or at /dev/null keep going."""
+
+    def __init__(self, window="Card Detector", headless=False, every=1, scale=1.0):
+        self.window = window
+        self.headless = headless
+        self.every = max(int(every), 1)
+        self.scale = scale
+        self.count = 0 # Frames offered since the start
+        self.shown = False # A frame was shown since keys were last polled
+        # Keys from stdin or signals. SimpleQueue.put can be called from a
+        # signal handler, even while the main thread is inside get_nowait.
+        self.keys = queue.SimpleQueue()
+        self.quit = False # Set by a quit signal
+
+        if headless:
+            self.listen()
+
+    def listen(self):
+        """Starts taking key commands from stdin and from signals."""
+
+        def read_stdin():
+            for line in sys.stdin:
+                line = line.strip()
+                if line:
+                    self.keys.put(line[0].lower())
+            # At the end of input (e.g. under a service manager or nohup)
+            # only signals are left to control the run
+
+        if sys.stdin is not None and not sys.stdin.closed:
+            threading.Thread(target=read_stdin, daemon=True).start()
+
+        # Signal handlers can only be installed from the main thread
+        if threading.current_thread() is threading.main_thread():
+            for name, key in SIGNAL_KEYS.items():
+                if hasattr(signal, name):
+                    signal.signal(getattr(signal, name), lambda signum, frame, key=key: self.keys.put(key))
+            for name in QUIT_SIGNALS:
+                if hasattr(signal, name):
+                    signal.signal(getattr(signal, name), lambda signum, frame: setattr(self, 'quit', True))
+
+    def due(self):
+        """Counts a frame and returns True if it should be rendered. Callers
+        only need to draw their overlay on frames that are due."""
+
+        self.count = self.count + 1
+        return not self.headless and (self.count - 1) % self.every == 0
+
+    def show(self, image):
+        """Shows a frame, shrunk by the preview scale."""
+
+        if self.headless:
+            return
+        if self.scale != 1:
+            image = cv2.resize(image, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_NEAREST)
+        cv2.imshow(self.window, image)
+        self.shown = True
+
+    def poll_key(self):
+        """Returns the next key command as a one character string, or None.
+        The window is only polled after a frame was shown."""
+
+        if not self.headless and self.shown:
+            self.shown = False
+            key = cv2.waitKey(1) & 0xFF
+            if key != 0xFF:
+                self.keys.put(chr(key))
+        try:
+            return self.keys.get_nowait()
+        except queue.Empty:
+            return None
+
+    def close(self):
+        """Closes the preview window, if there is one."""
+
+        if not self.headless:
+            cv2.destroyAllWindows()
+
+
+def is_headless(default=False):
+    """Returns True if the CARD_HEADLESS environment variable asks for
+    headless mode, or default if it isn't set."""
+
+    value = os.environ.get('CARD_HEADLESS')
+    if value is None:
+        return default
+    return value.lower() not in ('', '0', 'false', 'no')
@@ -0,0 +1,210 @@
+### On-demand profiling of the live detection loop ###
+#
+# A running assistant can be profiled without restarting it: a key press,
+# SIGUSR2 or a control file starts a profile of the next PROFILE_FRAMES
+# frames (or PROFILE_SECONDS seconds) of the detection loop. Every frame is
+# tagged with the number of cards in view, so hot spots can be told apart
+# by table conditions. Results are written as collapsed stacks for flame
+# graph tools, where the Cards stage each sample was taken in is added below
+# the card count, or as pstats files (one per card count), which have no
+# stage annotation.
+
+import os
+import sys
+import time
+import signal
+import cProfile
+import threading
+import Metrics
+
+# Length of one profile, whichever limit is reached first. Only time spent
+# in the loop counts, so a profile can span several scans.
+PROFILE_FRAMES = 100
+PROFILE_SECONDS = 10.0
+
+# Output formats, and the default one. Only 'collapsed' is annotated with
+# the Cards stage.
+PROFILE_FORMATS = ['collapsed', 'pstats']
+PROFILE_FORMAT = 'collapsed'
+
+# Seconds between stack samples in the 'collapsed' format
+SAMPLE_INTERVAL = 0.001
+
+# Frames between checks for the control file
+CONTROL_CHECK_EVERY = 10
+
+# Signal that starts or stops a profile, where it exists
+PROFILE_SIGNAL = 'SIGUSR2'
+
+# File name of the module whose pipeline stages samples are attributed to
+STAGE_MODULE = 'Cards.py'
+
+
+class Frame_profiler:
+    """Profiles a bounded window of frames of a detection loop on request.
+    The loop calls frame_start() when it starts on a frame and frame_end()
+    with the number of cards in view when it is done with it. request()
+    starts a profile at the next frame, or ends a running one early."""
+
+    def __init__(self, out_dir='.', frames=PROFILE_FRAMES, seconds=PROFILE_SECONDS, fmt=PROFILE_FORMAT,
+                 control_file=None):
+        if fmt not in PROFILE_FORMATS:
+            raise ValueError("Unknown profile format '%s'" % fmt)
+        self.out_dir = out_dir
+        self.frames = frames
+        self.seconds = seconds
+        self.fmt = fmt
+        self.control_file = control_file
+
+        self.requested = False
+        self.active = False
+        self.frame_count = 0
+        self.checks = 0
+        self.elapsed = 0.0 # Seconds spent in profiled frames
+        self.frame_time = 0.0
+
+        # 'pstats': one cProfile.Profile per card count. 'collapsed': stack
+        # counts, and the samples of the frame being profiled.
+        self.profiles = {}
+        self.current = None
+        self.stacks = {}
+        self.samples = []
+        self.lock = threading.Lock()
+        self.sampler = None
+        self.thread_id = None
+
+    def listen(self):
+        """Starts or stops profiles on PROFILE_SIGNAL. Must be called from
+        the main thread."""
+
+        if hasattr(signal, PROFILE_SIGNAL):
+            signal.signal(getattr(signal, PROFILE_SIGNAL), lambda signum, frame: self.request())
+        return self
+
+    def request(self):
+        """Asks for a profile to start at the next frame, or for the running
+        one to end."""
+
+        self.requested = True
+
+    def frame_start(self):
+        """Called by the loop before it works on a frame."""
+
+        if self.control_file is not None and not self.active:
+            self.checks = self.checks + 1
+            if self.checks % CONTROL_CHECK_EVERY == 0 and os.path.exists(self.control_file):
+                os.remove(self.control_file)
+                self.requested = True
+
+        if self.requested:
+            self.requested = False
+            if self.active:
+                self.finish()
+                return
+            self.begin()
+
+        if not self.active:
+            return
+        self.frame_time = time.perf_counter()
+        if self.fmt == 'pstats':
+            self.current = cProfile.Profile()
+            self.current.enable()
+        else:
+            with self.lock:
+                self.samples = []
+
+    def frame_end(self, cards=0):
+        """Called by the loop when it is done with a frame, with the number
+        of cards that were in view."""
+
+        if not self.active:
+            return
+        if self.fmt == 'pstats':
+            self.current.disable()
+            if cards in self.profiles:
+                # Profiles of the same card count are merged when written
+                self.profiles[cards].append(self.current)
+            else:
+                self.profiles[cards] = [self.current]
+            self.current = None
+        else:
+            with self.lock:
+                samples, self.samples = self.samples, []
+            for stack in samples:
+                key = 'cards=%d;%s' % (cards, stack)
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+        self.frame_count = self.frame_count + 1
+        self.elapsed = self.elapsed + time.perf_counter() - self.frame_time
+        if self.frame_count >= self.frames or self.elapsed >= self.seconds:
+            self.finish()
+
+    def begin(self):
+        """Starts a profile."""
+
+        self.active = True
+        self.frame_count = 0
+        self.elapsed = 0.0
+        self.profiles = {}
+        self.stacks = {}
+        print("Profiling the next %d frames or %.0f s..." % (self.frames, self.seconds))
+        if self.fmt == 'collapsed':
+            self.thread_id = threading.get_ident()
+            self.sampler = threading.Thread(target=self.sample, daemon=True)
+            self.sampler.start()
+
+    def sample(self):
+        """Sampler thread for the 'collapsed' format. Records the stack of
+        the profiled thread every SAMPLE_INTERVAL seconds."""
+
+        while self.active:
+            time.sleep(SAMPLE_INTERVAL)
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            # The stage is the outermost Cards stage on the stack, so time
+            # spent in its helpers counts for it
+            names = []
+            stage = 'other'
+            while frame is not None:
+                code = frame.f_code
+                if code.co_name in Metrics.CARD_STAGES and code.co_filename.endswith(STAGE_MODULE):
+                    stage = code.co_name
+                names.append('%s:%s' % (os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            stack = 'stage=%s;%s' % (stage, ';'.join(reversed(names)))
+            with self.lock:
+                self.samples.append(stack)
+
+    def finish(self):
+        """Ends the running profile and writes it out. Returns the list of
+        files written."""
+
+        self.active = False
+        if self.current is not None:
+            self.current.disable()
+            self.current = None
+        if self.sampler is not None:
+            self.sampler.join()
+            self.sampler = None
+
+        base = os.path.join(self.out_dir, time.strftime('profile-%Y%m%d-%H%M%S'))
+        paths = []
+        if self.fmt == 'pstats':
+            import pstats
+            for cards, profiles in sorted(self.profiles.items()):
+                stats = pstats.Stats(profiles[0])
+                for profile in profiles[1:]:
+                    stats.add(profile)
+                path = '%s-cards%d.pstats' % (base, cards)
+                stats.dump_stats(path)
+                paths.append(path)
+        else:
+            path = base + '.folded'
+            with open(path, 'w') as f:
+                for stack, count in sorted(self.stacks.items()):
+                    f.write('%s %d\n' % (stack, count))
+            paths.append(path)
+
+        print("Profile of %d frames written to %s" % (self.frame_count, ', '.join(paths)))
+        return paths
@@ -0,0 +1,180 @@
+### Synthetic blackjack table scenes ###
+#
+# Builds camera-like frames of cards on felt from the rank and suit images
+# in Card_Imgs/, with ground truth labels, so detection accuracy and
+# throughput can be measured without real footage.
+
+import os
+import numpy as np
+import cv2
+import Cards
+
+# Card face size, in the 200x300 coordinates of the flattened card that
+# Cards.flattener produces, and the oversampling used when drawing it
+FACE_WIDTH = 200
+FACE_HEIGHT = 300
+FACE_SCALE = 2
+
+# Where the rank and suit glyphs are drawn on the card face (x, y, w, h).
+# They sit inside the CORNER_WIDTH x CORNER_HEIGHT corner that
+# Cards.preprocess_card reads the rank and suit from.
+RANK_BOX = (4, 8, 23, 36)
+SUIT_BOX = (5, 51, 21, 28)
+
+# Felt and card colors (BGR)
+FELT_COLOR = (40, 95, 30)
+CARD_COLOR = (235, 235, 235)
+BLACK_INK = (20, 20, 20)
+RED_INK = (30, 30, 190)
+RED_SUITS = ['Hearts', 'Diamonds']
+
+# Rows of the frame kept free of cards, so the background pixel that
+# Cards.preprocess_image samples to set its threshold is always felt
+TOP_MARGIN = 0.05
+
+
+class Scene_options:
+    """Structure to store the random variations applied to a scene."""
+
+    def __init__(self):
+        self.rotation = 15 # Maximum card rotation in degrees
+        self.diamond = 0.2 # Probability of a card being 'diamond' oriented (about 45 degrees)
+        self.perspective = 0.04 # Maximum corner jitter, as a fraction of card width
+        self.blur = 1.0 # Maximum Gaussian blur sigma in pixels
+        self.noise = 4.0 # Maximum standard deviation of Gaussian noise
+        self.brightness = 30 # Maximum brightness shift, in gray levels
+
+
+class Table_generator:
+    """Draws synthetic table frames with cards made from the train images."""
+
+    def __init__(self, filepath=None, seed=0):
+        if filepath is None:
+            filepath = os.path.dirname(os.path.abspath(__file__)) + '/Card_Imgs/'
+        self.ranks = Cards.load_ranks(filepath)
+        self.suits = Cards.load_suits(filepath)
+        self.rng = np.random.default_rng(seed)
+        self.faces = {} # Card face images, drawn on first use
+
+    def card_face(self, rank, suit):
+        """Returns the flattened face image of a card, oversampled by FACE_SCALE."""
+
+        key = (rank.name, suit.name)
+        if key in self.faces:
+            return self.faces[key]
+
+        face = np.full((FACE_HEIGHT * FACE_SCALE, FACE_WIDTH * FACE_SCALE, 3), CARD_COLOR, np.uint8)
+        ink = RED_INK if suit.name in RED_SUITS else BLACK_INK
+
+        # Rank and suit in the corner, plus a large suit in the middle
+        for img, (x, y, w, h) in [(rank.img, RANK_BOX), (suit.img, SUIT_BOX),
+                                  (suit.img, (70, 110, 60, 80))]:
+            glyph = cv2.resize(img, (w * FACE_SCALE, h * FACE_SCALE)) > 127
+            roi = face[y * FACE_SCALE:(y + h) * FACE_SCALE, x * FACE_SCALE:(x + w) * FACE_SCALE]
+            roi[glyph] = ink
+
+        self.faces[key] = face
+        return face
+
+    def card_corners(self, center, card_h, options):
+        """Returns the four frame corners (top left, top right, bottom right,
+        bottom left) of a card centered at center, randomly rotated and
+        perspective distorted."""
+
+        card_w = card_h * FACE_WIDTH / FACE_HEIGHT
+        if self.rng.random() < options.diamond:
+            angle = self.rng.choice([-1, 1]) * (45 + self.rng.uniform(-5, 5))
+        else:
+            angle = self.rng.uniform(-options.rotation, options.rotation)
+
+        half = np.array([[-card_w, -card_h], [card_w, -card_h],
+                         [card_w, card_h], [-card_w, card_h]]) / 2
+        theta = np.deg2rad(angle)
+        rot = np.array([[np.cos(theta), -np.sin(theta)], [np.sin(theta), np.cos(theta)]])
+        corners = half @ rot.T + center
+        corners = corners + self.rng.uniform(-1, 1, (4, 2)) * options.perspective * card_w
+        return corners.astype(np.float32)
+
+    def scene(self, num_cards, resolution=(1280, 720), options=None):
+        """Draws one frame with num_cards cards on the felt. Returns the BGR
+        image and a list of ground truth labels, one dictionary per card with
+        its 'rank', 'suit', 'center' and 'corners'."""
+
+        if options is None:
+            options = Scene_options()
+        width, height = resolution
+        rng = self.rng
+
+        # Felt with some texture
+        image = np.empty((height, width, 3), np.uint8)
+        image[:] = FELT_COLOR
+        texture = rng.normal(0, 3, (height, width, 1))
+        image = np.clip(image + texture, 0, 255).astype(np.uint8)
+
+        # Lay the cards out on a grid, one card per cell, so they never overlap
+        rows = 1 if num_cards <= 4 else 2 if num_cards <= 10 else 3
+        cols = max(int(np.ceil(num_cards / rows)), 1)
+        top = int(height * TOP_MARGIN)
+        cell_w = width / cols
+        cell_h = (height - top) / rows
+        card_h = min(0.75 * min(cell_h, cell_w * FACE_HEIGHT / FACE_WIDTH), 0.4 * height)
+        cells = rng.permutation(rows * cols)[:num_cards]
+
+        labels = []
+        face_corners = np.float32([[0, 0], [FACE_WIDTH * FACE_SCALE - 1, 0],
+                                   [FACE_WIDTH * FACE_SCALE - 1, FACE_HEIGHT * FACE_SCALE - 1],
+                                   [0, FACE_HEIGHT * FACE_SCALE - 1]])
+        for cell in cells:
+            row, col = divmod(int(cell), cols)
+            slack = 0.1 * np.array([cell_w, cell_h])
+            center = (np.array([(col + 0.5) * cell_w, top + (row + 0.5) * cell_h])
+                      + rng.uniform(-1, 1, 2) * slack)
+            rank = self.ranks[rng.integers(len(self.ranks))]
+            suit = self.suits[rng.integers(len(self.suits))]
+            corners = self.card_corners(center, card_h, options)
+
+            # Warp the card face onto the frame and paste it through its mask
+            M = cv2.getPerspectiveTransform(face_corners, corners)
+            face = self.card_face(rank, suit)
+            warp = cv2.warpPerspective(face, M, (width, height), flags=cv2.INTER_AREA)
+            mask = cv2.warpPerspective(np.full(face.shape[:2], 255, np.uint8), M, (width, height))
+            mask = mask > 127
+            image[mask] = warp[mask]
+
+            labels.append({'rank': rank.name, 'suit': suit.name,
+                           'center': center.tolist(), 'corners': corners.tolist()})
+
+        # Camera effects: brightness shift, blur and sensor noise
+        shift = rng.uniform(-options.brightness, options.brightness)
+        image = np.clip(image.astype(np.float32) + shift, 0, 255)
+        sigma = rng.uniform(0, options.blur)
+        if sigma > 0.1:
+            image = cv2.GaussianBlur(image, (0, 0), sigma)
+        image = image + rng.normal(0, rng.uniform(0, options.noise), image.shape)
+        image = np.clip(image, 0, 255).astype(np.uint8)
+
+        return image, labels
+
+
+def score_detections(cards, labels):
+    """Compares detected query cards with the ground truth labels of a
+    scene. A detection counts for the nearest label whose card it lies on.
+    Returns (found, rank_correct, suit_correct, false_positives)."""
+
+    found = rank_correct = suit_correct = false_positives = 0
+    unmatched = list(labels)
+    for card in cards:
+        best = None
+        for label in unmatched:
+            inside = cv2.pointPolygonTest(np.float32(label['corners']), tuple(map(float, card.center)), False)
+            if inside >= 0:
+                best = label
+                break
+        if best is None:
+            false_positives = false_positives + 1
+            continue
+        unmatched.remove(best)
+        found = found + 1
+        rank_correct = rank_correct + (card.best_rank_match == best['rank'])
+        suit_correct = suit_correct + (card.best_suit_match == best['suit'])
+    return found, rank_correct, suit_correct, false_positives
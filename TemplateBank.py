@@ -0,0 +1,216 @@
+### Precompiled, memory-mapped template bank ###
+#
+# Loading the train images used to mean decoding 17 JPEGs with cv2.imread
+# and stacking, bit-packing and downscaling them again, on every start and
+# in every worker process. build() does that once and writes all stacks
+# into a single versioned file. load() maps the file read-only, so opening
+# it costs no decoding, and processes that load the same file share its
+# pages in the OS page cache instead of each holding a copy.
+#
+# File layout: MAGIC, a little endian uint32 format version and header
+# length, a JSON header, then the arrays, each starting on a BANK_ALIGN
+# byte boundary. The header lists the names of every bank, the dtype,
+# shape, offset and CRC-32 of each array, the CRC-32 of each source JPEG
+# and the Cards settings the stacks were derived with, so a bank built from
+# other images or settings is detected and rebuilt.
+#
+# Usage: python TemplateBank.py [Card_Imgs directory] [-o bank file]
+
+import os
+import json
+import zlib
+import struct
+import tempfile
+import argparse
+import numpy as np
+import Cards
+
+MAGIC = b'CARDBANK'
+BANK_VERSION = 1
+
+# File name of the bank, next to the train images it is built from
+BANK_FILE = 'templates.bank'
+
+# Alignment of every array in the file, in bytes
+BANK_ALIGN = 64
+
+# Arrays stored for every Train_bank
+BANK_ARRAYS = ['imgs', 'packed', 'coarse']
+
+# Train images of each bank in the file
+BANK_SOURCES = {'ranks': Cards.RANK_NAMES, 'suits': Cards.SUIT_NAMES}
+
+
+def build_params():
+    """Returns the Cards settings the packed and coarse stacks depend on.
+    Queries are packed and downscaled with the current values, so a bank
+    built with other values would be compared against stale templates."""
+
+    return {'binary_thresh': Cards.BINARY_THRESH, 'coarse_scale': Cards.COARSE_SCALE}
+
+
+def default_filepath():
+    return os.path.dirname(os.path.abspath(__file__)) + '/Card_Imgs/'
+
+
+def source_checksums(filepath):
+    """Returns {file name: CRC-32} of the train JPEGs in filepath. Reads the
+    files without decoding them."""
+
+    checksums = {}
+    for names in BANK_SOURCES.values():
+        for name in names:
+            with open(os.path.join(filepath, name + '.jpg'), 'rb') as f:
+                checksums[name + '.jpg'] = zlib.crc32(f.read())
+    return checksums
+
+
+def build(filepath=None, path=None):
+    """Decodes the train images in filepath and writes them, with their
+    bit-packed and downscaled stacks, into the bank file path (BANK_FILE in
+    filepath by default). The file is replaced atomically. Returns path."""
+
+    if filepath is None:
+        filepath = default_filepath()
+    if path is None:
+        path = os.path.join(filepath, BANK_FILE)
+
+    banks = {'ranks': Cards.Train_bank(Cards.load_ranks(filepath)),
+             'suits': Cards.Train_bank(Cards.load_suits(filepath))}
+    header = {'version': BANK_VERSION, 'sources': source_checksums(filepath), 'params': build_params(),
+              'banks': {}}
+    arrays = []
+    offset = 0
+    for bank_name, bank in banks.items():
+        entry = {'names': bank.names, 'coarse_scale': bank.coarse_scale, 'arrays': {}}
+        for array_name in BANK_ARRAYS:
+            array = np.ascontiguousarray(getattr(bank, array_name))
+            offset = -(-offset // BANK_ALIGN) * BANK_ALIGN
+            entry['arrays'][array_name] = {'dtype': array.dtype.str, 'shape': list(array.shape),
+                                           'offset': offset, 'crc32': zlib.crc32(array.tobytes())}
+            arrays.append((offset, array))
+            offset = offset + array.nbytes
+        header['banks'][bank_name] = entry
+
+    # Array offsets are relative to the data start, which follows the
+    # header rounded up to BANK_ALIGN
+    text = json.dumps(header).encode()
+    start = -(-(len(MAGIC) + 8 + len(text)) // BANK_ALIGN) * BANK_ALIGN
+    # Several processes may rebuild the bank at once, so each writes its own
+    # temporary file next to the bank and the last replace wins
+    fd, temp = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp',
+                                dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(MAGIC + struct.pack('<II', BANK_VERSION, len(text)) + text)
+            for array_offset, array in arrays:
+                f.seek(start + array_offset)
+                f.write(array.tobytes())
+        os.chmod(temp, 0o644)
+        os.replace(temp, path)
+    except BaseException:
+        os.unlink(temp)
+        raise
+    return path
+
+
+def read_header(path):
+    """Returns (header, data start offset) of a bank file. Raises ValueError
+    if it isn't a bank file of this version."""
+
+    with open(path, 'rb') as f:
+        prefix = f.read(len(MAGIC) + 8)
+        if len(prefix) < len(MAGIC) + 8 or prefix[:len(MAGIC)] != MAGIC:
+            raise ValueError("%s is not a template bank" % path)
+        version, length = struct.unpack('<II', prefix[len(MAGIC):])
+        if version != BANK_VERSION:
+            raise ValueError("%s is a version %d template bank, expected %d" % (path, version, BANK_VERSION))
+        header = json.loads(f.read(length))
+    start = -(-(len(MAGIC) + 8 + length) // BANK_ALIGN) * BANK_ALIGN
+    return header, start
+
+
+def load(path, verify=True):
+    """Maps a bank file read-only and returns (rank_bank, suit_bank) as
+    Train_bank objects whose stacks are views of the mapping. If verify is
+    True, the checksum of every array is checked, which reads the whole
+    file once. Raises ValueError on a damaged or outdated file."""
+
+    header, start = read_header(path)
+    if header.get('params') != build_params():
+        raise ValueError("%s was built with other Cards settings, rebuild it" % path)
+    # Plain ndarray views of the mapping, which keep it open
+    data = np.asarray(np.memmap(path, dtype=np.uint8, mode='r'))
+    banks = {}
+    for bank_name, entry in header['banks'].items():
+        stacks = {}
+        for array_name, info in entry['arrays'].items():
+            dtype = np.dtype(info['dtype'])
+            size = int(np.prod(info['shape'])) * dtype.itemsize
+            begin = start + info['offset']
+            if begin + size > len(data):
+                raise ValueError("%s is truncated" % path)
+            raw = data[begin:begin + size]
+            if verify and zlib.crc32(raw) != info['crc32']:
+                raise ValueError("Checksum mismatch in %s of %s" % (array_name, path))
+            stacks[array_name] = raw.view(dtype).reshape(info['shape'])
+        banks[bank_name] = Cards.Train_bank(names=entry['names'], coarse_scale=entry['coarse_scale'], **stacks)
+    return banks['ranks'], banks['suits']
+
+
+def is_current(path, filepath):
+    """Returns True if path is a readable bank built from the train images
+    now in filepath, with the current Cards settings."""
+
+    try:
+        header = read_header(path)[0]
+    except (OSError, ValueError):
+        return False
+    return header.get('params') == build_params() and header['sources'] == source_checksums(filepath)
+
+
+def ensure_bank(filepath=None):
+    """Returns the path of a current bank for the train images in filepath,
+    building it first if it is missing or outdated. If the image directory
+    isn't writable, the bank is kept in the temporary directory instead."""
+
+    if filepath is None:
+        filepath = default_filepath()
+    path = os.path.join(filepath, BANK_FILE)
+    if is_current(path, filepath):
+        return path
+    try:
+        return build(filepath, path)
+    except OSError:
+        path = os.path.join(tempfile.gettempdir(), BANK_FILE)
+        if is_current(path, filepath):
+            return path
+        return build(filepath, path)
+
+
+def load_banks(filepath=None, verify=True):
+    """Returns (rank_bank, suit_bank) for the train images in filepath,
+    memory-mapped from their bank file, which is built if needed. Drop-in
+    replacement for Train_bank(load_ranks(...)), Train_bank(load_suits(...))."""
+
+    return load(ensure_bank(filepath), verify)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile the train images into a template bank file.")
+    parser.add_argument('filepath', nargs='?', default=default_filepath(), help="directory of the train JPEGs")
+    parser.add_argument('-o', '--output', default=None, help="bank file to write (default: %s in the directory)" % BANK_FILE)
+    args = parser.parse_args()
+
+    filepath = os.path.join(args.filepath, '')
+    path = build(filepath, args.output)
+    header, start = read_header(path)
+    for bank_name, entry in header['banks'].items():
+        print("%s: %d templates, %s" % (bank_name, len(entry['names']),
+                                        ', '.join('%s %s' % (name, 'x'.join(map(str, info['shape'])))
+                                                  for name, info in entry['arrays'].items())))
+    print("Wrote %s (%d bytes)" % (path, os.path.getsize(path)))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,47 @@
 # Import the necessary packages
-from threading import Thread
+from threading import Thread, Condition, Lock
+import os
+import time
+import numpy as np
 import cv2
 
+# File extensions FileVideoStream treats as still images in a directory
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+# Default number of preallocated frame buffers in the capture ring
+RING_DEPTH = 4
+
+# Driver buffer size used in low latency mode when none is given, so the
+# driver never queues up stale frames
+LOW_LATENCY_BUFFER_SIZE = 1
+
 
 class VideoStream:
-    """Camera object"""
-    def __init__(self, resolution=(640,480),framerate=30,PiOrUSB=1,src=0):
+    """Camera object.
+
+    Frames are decoded in place into a ring of ring_depth preallocated
+    buffers. read, read_stamped and read_new hand out a private, writable
+    copy of the newest buffer, as read always did. Pass copy=False to get a
+    read-only view of it instead, which costs no copy and stays valid until
+    the ring wraps around, that is for ring_depth - 1 further frames.
+
+    With low_latency=True (USB camera only) the capture thread only grab()s
+    frames, which keeps the driver buffer drained, and a frame is decoded
+    with retrieve() when a reader asks for it. Readers then always get the
+    newest frame no matter how slow they are, and frames they skip are never
+    decoded. fourcc (e.g. 'MJPG' or 'YUYV'), buffer_size and resolution are
+    requested from the driver; what it negotiated is stored in self.fourcc
+    and self.resolution. src can also be a video file, which is then paced
+    at framerate to stand in for a camera."""
+    def __init__(self, resolution=(640,480),framerate=30,PiOrUSB=1,src=0,ring_depth=RING_DEPTH,
+                 low_latency=False,fourcc=None,buffer_size=None):
 
         # Create a variable to indicate if it's a USB camera or PiCamera.
         # PiOrUSB = 1 will use PiCamera. PiOrUSB = 2 will use USB camera.
         self.PiOrUSB = PiOrUSB
+        self.framerate = framerate
+        self.low_latency = low_latency and PiOrUSB == 2
+        self.init_buffers(ring_depth)
 
         # if self.PiOrUSB == 1: # PiCamera
         #     # Import packages from picamera library
@@ -30,12 +62,17 @@ class VideoStream:
         if self.PiOrUSB == 2: # USB camera
             # Initialize the USB camera and the camera image stream
             self.stream = cv2.VideoCapture(src)
-            ret = self.stream.set(3,resolution[0])
-            ret = self.stream.set(4,resolution[1])
+            self.is_file = isinstance(src, str) and os.path.isfile(src)
+            if low_latency and buffer_size is None:
+                buffer_size = LOW_LATENCY_BUFFER_SIZE
+            self.configure(resolution, fourcc, buffer_size)
             #ret = self.stream.set(5,framerate) #Doesn't seem to do anything so it's commented out
 
             # Read first frame from the stream
-            (self.grabbed, self.frame) = self.stream.read()
+            self.publish(*self.stream.read())
+            self.grab_count = self.seq
+            self.grab_time = self.timestamp
+            self.decoded_seq = self.seq
 
 	# Create a variable to control when the camera is stopped
         self.stopped = False
@@ -53,7 +90,7 @@ class VideoStream:
             for f in self.stream:
                 # Grab the frame from the stream and clear the stream
                 # in preparation for the next frame
-                self.frame = f.array
+                self.publish(True, f.array)
                 self.rawCapture.truncate(0)
 
                 if self.stopped:
@@ -62,7 +99,13 @@ class VideoStream:
                     self.rawCapture.close()
                     self.camera.close()
 
-        if self.PiOrUSB == 2: # USB camera
+        if self.PiOrUSB == 2 and self.low_latency: # USB camera, decode on demand
+            self.grab_loop()
+
+        elif self.PiOrUSB == 2: # USB camera
+
+            period = 1.0 / self.framerate if self.is_file and self.framerate else 0
+            next_time = time.perf_counter()
 
             # Keep looping indefinitely until the thread is stopped
             while True:
@@ -72,13 +115,294 @@ class VideoStream:
                     self.stream.release()
                     return
 
-                # Otherwise, grab the next frame from the stream
-                (self.grabbed, self.frame) = self.stream.read()
+                # Video files are paced like a camera would deliver them
+                if period:
+                    next_time = next_time + period
+                    delay = next_time - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+
+                # Otherwise, decode the next frame straight into the ring
+                grabbed, frame = self.stream.read(self.write_slot())
+                self.publish(grabbed, frame)
+
+                # A video file that ran out wakes up its readers and ends
+                if not grabbed and self.is_file:
+                    with self.condition:
+                        self.finished = True
+                        self.condition.notify_all()
+                    self.stream.release()
+                    return
+
+    def configure(self, resolution, fourcc=None, buffer_size=None):
+        """Requests a pixel format, driver buffer size and resolution from
+        the camera, and records the format and resolution it negotiated."""
+
+        # The pixel format has to be set first, many drivers only offer
+        # high resolutions at a good frame rate with MJPG
+        if fourcc is not None:
+            self.stream.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*fourcc))
+        if buffer_size is not None:
+            self.stream.set(cv2.CAP_PROP_BUFFERSIZE, buffer_size)
+        self.stream.set(cv2.CAP_PROP_FRAME_WIDTH, resolution[0])
+        self.stream.set(cv2.CAP_PROP_FRAME_HEIGHT, resolution[1])
+
+        code = int(self.stream.get(cv2.CAP_PROP_FOURCC))
+        self.fourcc = ''.join(chr((code >> (8 * i)) & 0xFF) for i in range(4))
+        self.resolution = (int(self.stream.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                           int(self.stream.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+
+    def grab_loop(self):
+        """Capture loop of the low latency mode. Keeps grabbing frames
+        without decoding them until the thread is stopped."""
+
+        period = 1.0 / self.framerate if self.is_file and self.framerate else 0
+        next_time = time.perf_counter()
+
+        while not self.stopped:
+            # Video files are paced like a camera would deliver them
+            if period:
+                next_time = next_time + period
+                delay = next_time - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+
+            # VideoCapture is not thread safe, grab and retrieve share a lock
+            with self.capture_lock:
+                grabbed = self.stream.grab()
+                if grabbed:
+                    if self.metrics is not None and self.grab_count:
+                        self.metrics.observe('capture_interval_seconds', time.monotonic() - self.grab_time)
+                    self.grab_count = self.grab_count + 1
+                    self.grab_time = time.monotonic()
+                count, stamp = self.grab_count, self.grab_time
+
+            with self.condition:
+                self.grabbed = grabbed
+                if grabbed and count > self.seq:
+                    if self.seq > self.read_seq:
+                        self.dropped_frames = self.dropped_frames + 1
+                    self.seq, self.timestamp = count, stamp
+                elif not grabbed and self.is_file:
+                    self.finished = True
+                self.condition.notify_all()
+
+            if self.finished:
+                break
+
+        with self.capture_lock:
+            self.stream.release()
+
+    def retrieve(self):
+        """Decodes the most recently grabbed frame into the ring. Must be
+        called with the condition held."""
+
+        start = time.perf_counter()
+        with self.capture_lock:
+            slot = self.write_slot()
+            grabbed, frame = self.stream.retrieve(slot)
+            count, stamp = self.grab_count, self.grab_time
+        if self.metrics is not None:
+            self.metrics.observe('decode_seconds', time.perf_counter() - start)
+        if grabbed:
+            self.store_frame(frame)
+            self.seq, self.timestamp = max(self.seq, count), stamp
+            self.decoded_seq = self.seq
+
+    def init_buffers(self, ring_depth):
+        """Sets up the frame ring and the sequence number bookkeeping."""
+
+        # Every published frame gets the next sequence number and the
+        # time.monotonic() time it was captured. The condition guards them
+        # and wakes up readers waiting in read_new.
+        self.condition = Condition()
+        self.seq = 0
+        self.timestamp = 0.0
+        self.grabbed, self.frame = False, None
+        self.finished = False # Set when a file-backed stream runs out of frames
+
+        # The ring is allocated once the first frame shows its size
+        self.ring_depth = ring_depth
+        self.ring = None
+        self.slots = []
+        self.index = -1 # Slot holding the newest frame
+        self.read_seq = 0 # Newest sequence number handed out to a reader
+        self.dropped_frames = 0 # Frames replaced before any reader saw them
+        self.capture_lock = Lock() # Serializes grab and retrieve in low latency mode
+        self.metrics = None # Metrics.Registry the capture timings are reported to, if any
+
+    def write_slot(self, shape=None):
+        """Returns the ring buffer the next frame should be decoded into,
+        (re)allocating the ring if it doesn't exist yet or if shape differs
+        from its frame size. Returns None while the frame size is unknown."""
+
+        if self.ring is None or (shape is not None and self.ring.shape[1:] != shape):
+            if shape is None:
+                return None
+            self.ring = np.empty((self.ring_depth,) + tuple(shape), dtype=np.uint8)
+            self.slots = [self.ring[i] for i in range(self.ring_depth)]
+            self.index = -1
+        return self.slots[(self.index + 1) % self.ring_depth]
 
-    def read(self):
+    def publish(self, grabbed, frame):
+        """Stores a newly captured frame, stamps it with the next sequence
+        number and capture time, and wakes up waiting readers. Frames that
+        were not decoded into the ring in place are copied into it."""
+
+        with self.condition:
+            self.grabbed = grabbed
+            if grabbed:
+                self.store_frame(frame)
+                if self.seq > self.read_seq:
+                    self.dropped_frames = self.dropped_frames + 1
+                now = time.monotonic()
+                if self.metrics is not None and self.seq:
+                    self.metrics.observe('capture_interval_seconds', now - self.timestamp)
+                self.seq = self.seq + 1
+                self.timestamp = now
+            self.condition.notify_all()
+
+    def store_frame(self, frame):
+        """Makes frame the newest frame of the ring, copying it in unless it
+        was decoded into the ring in place. Must be called with the
+        condition held."""
+
+        slot = self.write_slot(frame.shape)
+        if frame is not slot:
+            np.copyto(slot, frame)
+        self.index = (self.index + 1) % self.ring_depth
+        self.frame = slot
+
+    def hand_out(self, copy):
+        """Returns the newest frame as a read-only view, or as a writable
+        copy if copy is True. Must be called with the condition held."""
+
+        # In low latency mode the newest grabbed frame is decoded only now
+        if self.low_latency and self.decoded_seq < self.seq:
+            self.retrieve()
+        self.read_seq = self.seq
+        if self.frame is None:
+            return None
+        if copy:
+            return self.frame.copy()
+        view = self.frame.view()
+        view.flags.writeable = False
+        return view
+
+    def read(self, copy=True):
 		# Return the most recent frame
-        return self.frame
+        with self.condition:
+            return self.hand_out(copy)
+
+    def read_stamped(self, copy=True):
+        """Returns (seq, timestamp, frame) for the most recent frame."""
+
+        with self.condition:
+            return self.seq, self.timestamp, self.hand_out(copy)
+
+    def read_new(self, after_seq=0, timeout=None, copy=True):
+        """Blocks until a frame newer than after_seq is available and returns
+        it as (seq, timestamp, frame). Returns None if timeout seconds pass,
+        or the stream stops or runs out, before a new frame arrives."""
+
+        with self.condition:
+            self.condition.wait_for(
+                lambda: self.seq > after_seq or self.stopped or self.finished, timeout)
+            if self.seq <= after_seq:
+                return None
+            return self.seq, self.timestamp, self.hand_out(copy)
 
     def stop(self):
 		# Indicate that the camera and thread should be stopped
-        self.stopped = True
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+
+class FileVideoStream(VideoStream):
+    """Camera object that replays a video file or a directory of images.
+    Frames are served at framerate frames per second, or as fast as they can
+    be decoded if framerate is 0, so runs are reproducible without a camera."""
+    def __init__(self, src, framerate=0, loop=False, ring_depth=RING_DEPTH):
+
+        self.src = src
+        self.framerate = framerate
+        self.loop = loop
+        self.low_latency = False
+
+        # A directory is replayed as its images in sorted file name order,
+        # anything else is opened as a video file
+        if os.path.isdir(src):
+            self.paths = sorted(os.path.join(src, name) for name in os.listdir(src)
+                                if name.lower().endswith(IMAGE_EXTENSIONS))
+            self.stream = None
+        else:
+            self.paths = None
+            self.stream = cv2.VideoCapture(src)
+            if not self.stream.isOpened():
+                raise IOError("Could not open video file %s" % src)
+        self.position = 0
+        self.init_buffers(ring_depth)
+
+        # Read first frame from the file
+        self.publish(*self.next_frame())
+        self.stopped = False
+
+    def next_frame(self, out=None):
+        """Decodes the next frame, into out if it is given and the source is
+        a video. Returns (grabbed, frame) like cv2.VideoCapture.read(), with
+        grabbed False at the end of the file."""
+
+        if self.paths is not None:
+            if self.position >= len(self.paths):
+                if not self.loop or len(self.paths) == 0:
+                    return False, None
+                self.position = 0
+            frame = cv2.imread(self.paths[self.position])
+            self.position = self.position + 1
+            return frame is not None, frame
+
+        grabbed, frame = self.stream.read(out)
+        if not grabbed and self.loop:
+            self.stream.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            grabbed, frame = self.stream.read(out)
+        return grabbed, frame
+
+    def frames(self, max_frames=None):
+        """Yields every frame of the file once, in order, without the reader
+        thread. Used for deterministic benchmarks."""
+
+        count = 0
+        grabbed, frame = self.grabbed, self.frame
+        while grabbed and (max_frames is None or count < max_frames):
+            yield frame
+            count = count + 1
+            grabbed, frame = self.next_frame()
+        self.grabbed = False
+
+    def update(self):
+
+        period = 1.0 / self.framerate if self.framerate else 0
+        next_time = time.perf_counter()
+
+        # Keep looping until the thread is stopped or the file runs out
+        while not self.stopped:
+            if period:
+                next_time = next_time + period
+                delay = next_time - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+
+            grabbed, frame = self.next_frame(self.write_slot())
+            if not grabbed:
+                break
+            self.publish(grabbed, frame)
+
+        # Wake up readers waiting for frames that will never come
+        with self.condition:
+            self.grabbed = False
+            self.finished = True
+            self.condition.notify_all()
+
+        if self.stream is not None:
+            self.stream.release()